@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Load generator for the plugin logging server; needs neither calibre nor
+# a running server, e.g.
+# python benchmark.py --spawn --concurrency 50 --duration 20
+# python benchmark.py --spawn --server-args="--engine async" --rate 2000
+
+__license__ = 'GPL v3'
+__copyright__ = '2014, Gregory Riker'
+
+import argparse, httplib, json, os, random, shutil, signal, socket, subprocess
+import sys, tempfile, threading, time, uuid
+from collections import Counter
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+DEFAULT_MIX = "Log latest=45,Log all=45,unregistered=10"
+UNREGISTERED_PLUGIN = "Unregistered plugin"
+CALIBRE_VERSIONS = ('1.29.0', '1.30.0', '1.31.0')
+CALIBRE_OSES = ('Windows', 'OS X', 'Linux')
+
+
+class EventMix(object):
+    '''
+    Random events drawn from a weighted plugin mix, e.g.
+    "Log latest=45,Log all=45,unregistered=10"
+    '''
+
+    def __init__(self, mix, installs, extra_fields):
+        self.choices = []
+        for part in mix.split(','):
+            plugin, _, weight = part.rpartition('=')
+            if plugin.strip() == 'unregistered':
+                plugin = UNREGISTERED_PLUGIN
+            self.choices.append((plugin.strip(), float(weight)))
+        self.total = sum([weight for plugin, weight in self.choices])
+        self.installs = [str(uuid.uuid4()) for i in range(installs)]
+        self.extra_fields = extra_fields
+
+    def plugin(self, rng):
+        pick = rng.random() * self.total
+        for plugin, weight in self.choices:
+            pick -= weight
+            if pick < 0:
+                return plugin
+        return self.choices[-1][0]
+
+    def event(self, rng):
+        event = {'CALIBRE_PLUGIN': self.plugin(rng),
+                 'CALIBRE_VERSION': rng.choice(CALIBRE_VERSIONS),
+                 'CALIBRE_OS': rng.choice(CALIBRE_OSES),
+                 'CALIBRE_INSTALL_UUID': rng.choice(self.installs),
+                 'PLUGIN_VERSION': '1.{0}.{1}'.format(rng.randint(0, 3), rng.randint(0, 9))}
+        for i in range(self.extra_fields):
+            event['PLUGIN_EXTRA_{0}'.format(i)] = str(rng.randint(0, 1000))
+        return event
+
+
+class Results(object):
+    '''
+    Latencies and outcomes collected by the workers
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = Counter()
+        self.events = 0
+
+    def add(self, latency, outcome, events):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] += 1
+            self.events += events
+
+
+class Worker(threading.Thread):
+    '''
+    Issue requests until the schedule runs out
+    Closed loop: send as soon as the previous answer arrives
+    Open loop: send each request at its scheduled time, measuring latency
+    from that time so a stalled server cannot hide its queueing delay
+    '''
+
+    def __init__(self, bench, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.bench = bench
+        self.rng = random.Random(seed)
+        self.conn = None
+
+    def run(self):
+        bench = self.bench
+        while True:
+            scheduled = bench.next_slot()
+            if scheduled is None:
+                break
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            start = scheduled if bench.args.rate else time.time()
+            try:
+                if bench.args.bulk:
+                    outcome, events = self.send_bulk()
+                else:
+                    outcome, events = self.send_one()
+            except (socket.error, httplib.HTTPException) as e:
+                outcome, events = 'error: {0}'.format(e.__class__.__name__), 0
+                self.close()
+            bench.results.add(time.time() - start, outcome, events)
+        self.close()
+
+    def send_one(self):
+        status = self.request('GET', '/', None, self.bench.mix.event(self.rng))
+        return status, 1 if status == 200 else 0
+
+    def send_bulk(self):
+        events = [self.bench.mix.event(self.rng) for i in range(self.bench.args.bulk)]
+        body = '\n'.join([json.dumps(dict([(k.lower(), v) for k, v in e.items()])) for e in events])
+        status = self.request('POST', '/events', body, {'Content-Type': 'application/x-ndjson'})
+        accepted = json.loads(self.answer)['accepted'] if status == 200 else 0
+        return status, accepted
+
+    def request(self, method, path, body, headers):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.bench.args.host, self.bench.args.port, timeout=30)
+        if not self.bench.args.keep_alive:
+            headers['Connection'] = 'close'
+        self.conn.request(method, path, body, headers)
+        response = self.conn.getresponse()
+        self.answer = response.read()
+        if response.will_close:
+            self.close()
+        return response.status
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Benchmark(object):
+
+    def __init__(self):
+        self.args = self.init_parser()
+        self.mix = EventMix(self.args.mix, self.args.installs, self.args.extra_fields)
+        self.results = Results()
+        self.slot_lock = threading.Lock()
+        self.sent = 0
+        self.folder = None
+        self.server = None
+
+    def init_parser(self):
+        parser = argparse.ArgumentParser(description="Load generator for the plugin logging server")
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', default=8378, type=int)
+        parser.add_argument('--spawn', default=False, action='store_true',
+                            help='Start server.py on --port with a temporary logging folder')
+        parser.add_argument('--server-args', default='',
+                            help='Extra arguments for the spawned server, e.g. "--engine async"')
+        parser.add_argument('--keep-folder', default=False, action='store_true',
+                            help="Don't delete the spawned server's logging folder")
+        parser.add_argument('--concurrency', default=20, type=int,
+                            help='Concurrent connections')
+        parser.add_argument('--rate', default=0, type=float,
+                            help='Open loop: requests per second in total; 0 sends back to back')
+        parser.add_argument('--duration', default=10.0, type=float,
+                            help='Seconds to run')
+        parser.add_argument('--requests', default=0, type=int,
+                            help='Stop after this many requests instead')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help='Weighted plugins to log to; "unregistered" is a plugin the server rejects')
+        parser.add_argument('--extra-fields', default=0, type=int,
+                            help='PLUGIN_EXTRA_n fields added to each event')
+        parser.add_argument('--installs', default=1000, type=int,
+                            help='Distinct CALIBRE_INSTALL_UUIDs')
+        parser.add_argument('--bulk', default=0, type=int,
+                            help='Post this many events per request to /events instead of one per request')
+        parser.add_argument('--no-keep-alive', dest='keep_alive', default=True, action='store_false',
+                            help='Open a new connection for every request')
+        parser.add_argument('--seed', default=1, type=int)
+        return parser.parse_args()
+
+    def next_slot(self):
+        '''
+        Time at which the next request should be sent, or None when done
+        '''
+        with self.slot_lock:
+            if self.args.requests and self.sent >= self.args.requests:
+                return None
+            if self.args.rate:
+                scheduled = self.started + self.sent / self.args.rate
+            else:
+                scheduled = time.time()
+            if scheduled >= self.started + self.args.duration and not self.args.requests:
+                return None
+            self.sent += 1
+            return scheduled
+
+    def spawn_server(self):
+        self.folder = tempfile.mkdtemp(prefix='plugin_logger_bench_')
+        command = [sys.executable, SERVER, '-q', '--folder', self.folder,
+                   '--port', str(self.args.port)] + self.args.server_args.split()
+        self.server = subprocess.Popen(command)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                raise SystemExit("server exited with status {0}".format(self.server.returncode))
+            try:
+                socket.create_connection((self.args.host, self.args.port), 0.5).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise SystemExit("server did not start listening")
+
+    def stop_server(self):
+        self.server.send_signal(signal.SIGTERM)
+        self.server.wait()
+        if self.args.keep_folder:
+            print("server folder: {0}".format(self.folder))
+        else:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def run(self):
+        if self.args.spawn:
+            self.spawn_server()
+        try:
+            self.started = time.time()
+            workers = [Worker(self, self.args.seed + i) for i in range(self.args.concurrency)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(0.5)
+            self.elapsed = time.time() - self.started
+        finally:
+            if self.args.spawn:
+                self.stop_server()
+        self.report()
+
+    def report(self):
+        latencies = sorted(self.results.latencies)
+        count = len(latencies)
+        if not count:
+            print("no requests completed")
+            return
+
+        def percentile(fraction):
+            return latencies[min(count - 1, int(count * fraction))] * 1000
+
+        mode = "open loop at {0:g}/s".format(self.args.rate) if self.args.rate else "closed loop"
+        print("{0} requests in {1:.2f}s, {2}, {3} connections".format(
+            count, self.elapsed, mode, self.args.concurrency))
+        print("throughput: {0:.1f} requests/s, {1:.1f} events/s logged".format(
+            count / self.elapsed, self.results.events / self.elapsed))
+        print("latency ms: p50 {0:.2f}  p95 {1:.2f}  p99 {2:.2f}  max {3:.2f}".format(
+            percentile(0.50), percentile(0.95), percentile(0.99), latencies[-1] * 1000))
+        print("outcomes: {0}".format(", ".join(["{0}: {1}".format(outcome, n)
+                                               for outcome, n in self.results.outcomes.most_common()])))
+
+
+def main():
+    Benchmark().run()
+
+if __name__ == '__main__':
+    main()
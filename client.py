@@ -13,50 +13,269 @@ __copyright__ = '2014, Gregory Riker'
     If the server is not running, or not listening on the same port,
     the event will not be logged.
 
+    Plugins share a single PluginEventLogger per calibre process:
+        PluginEventLogger.instance().log_event('My plugin', '1.2.3',
+            CALIBRE_INSTALL_UUID=prefs['installation_uuid'])
+    log_event() only records the event and returns. A background thread
+    drops duplicates and posts what is left in batches, through calibre's
+    HTTP proxy if one is configured.
 """
 
-import logging, mechanize, time
-from threading import Thread
-from calibre import browser
+import atexit, base64, httplib, json, logging, socket, time, urllib, urlparse
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+from calibre import get_parsed_proxy
 from calibre.constants import (__appname__, __version__, iswindows, isosx,
         isportable, is64bit)
 from calibre.utils.config import prefs
 
 SERVER_URL = "http://localhost:8378"
+BULK_PATH = "/events"
 
+# Post when this many distinct events are waiting, or when the oldest has
+# waited FLUSH_INTERVAL seconds
+FLUSH_SIZE = 50
+FLUSH_INTERVAL = 5.0
 
-class PluginEventLogger(Thread):
+# Events beyond MAX_QUEUED are dropped until the worker catches up
+MAX_QUEUED = 1000
+
+# Failed posts are retried MAX_RETRIES times, waiting RETRY_DELAY seconds
+# doubled on each attempt, up to MAX_RETRY_DELAY
+MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# Seconds allowed for a final flush when calibre exits
+EXIT_TIMEOUT = 2.0
+CONNECTION_TIMEOUT = 10.0
+
+
+def utf8(value):
     '''
-    Post an event to the logging server
+    A field value as a byte string; calibre hands plugins unicode
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class PluginEventLogger(object):
+    '''
+    Post events to the logging server from one background thread
     '''
     URL = SERVER_URL
 
-    def __init__(self, plugin=None, version="0", verbose=True):
-        Thread.__init__(self)
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def instance(cls, verbose=False):
+        '''
+        Process-wide logger shared by all plugins
+        '''
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(verbose=verbose)
+            return cls._instance
+
+    def __init__(self, url=None, verbose=False):
+        self.url = url or self.URL
         self.verbose = verbose
-        self.plugin = plugin
-        self.plugin_version = str(version)
-        self.construct_header()
+        self.log = logging.getLogger('client')
+        self.pending = OrderedDict()
+        self.oldest = None
+        self.dropped = 0
+        self.condition = Condition()
+        self.stopping = False
+        self.worker = None
+        self.conn = None
+        # Set by connect(): request paths are absolute URLs through a proxy
+        self.prefix = ''
+        self.proxy_headers = {}
+        # None until the server has been asked, then True or False
+        self.bulk = None
 
-    def construct_header(self):
+    def log_event(self, plugin, version="0", **fields):
         '''
-        Build the default header information describing the environment
+        Queue an event for posting and return immediately
+        Extra fields are sent as headers, e.g. CALIBRE_INSTALL_UUID='…'
+        Returns False if the queue is full and the event was dropped
         '''
-        self.req = mechanize.Request(self.URL)
-        self.req.add_header('CALIBRE_VERSION', __version__)
-        self.req.add_header('CALIBRE_OS', 'Windows' if iswindows else 'OS X' if isosx else 'Linux')
-        self.req.add_header('CALIBRE_PLUGIN', self.plugin)
-        self.req.add_header('PLUGIN_VERSION', self.plugin_version)
+        event = OrderedDict()
+        event['CALIBRE_VERSION'] = __version__
+        event['CALIBRE_OS'] = 'Windows' if iswindows else 'OS X' if isosx else 'Linux'
+        event['CALIBRE_PLUGIN'] = utf8(plugin)
+        event['PLUGIN_VERSION'] = utf8(version)
+        for name, value in fields.items():
+            event[name.upper()] = utf8(value)
+
+        # A repeat of an event still waiting to be posted replaces it
+        key = (event.get('CALIBRE_INSTALL_UUID'), event['CALIBRE_PLUGIN'], event['PLUGIN_VERSION'])
+        with self.condition:
+            if key not in self.pending and len(self.pending) >= MAX_QUEUED:
+                self.dropped += 1
+                return False
+            self.pending[key] = event
+            if self.oldest is None:
+                self.oldest = time.time()
+            if self.worker is None:
+                self.start_worker()
+            elif len(self.pending) >= FLUSH_SIZE:
+                self.condition.notify()
+        return True
+
+    def start_worker(self):
+        self.worker = Thread(target=self.run, name='PluginEventLogger')
+        self.worker.daemon = True
+        self.worker.start()
+        atexit.register(self.stop, EXIT_TIMEOUT)
 
     def run(self):
-        br = browser()
-        try:
-            ans = br.open(self.req).read().strip()
-            if self.verbose:
-                logging.info("SERVER: {0}".format(ans))
-        except Exception as e:
-            import traceback
-            print("ERROR: {0}".format(traceback.format_exc()))
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    if self.pending:
+                        wait = self.oldest + FLUSH_INTERVAL - time.time()
+                        if len(self.pending) >= FLUSH_SIZE or wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.condition.wait(wait)
+                batch = list(self.pending.values())
+                self.pending.clear()
+                self.oldest = None
+                stopping = self.stopping
+            if batch:
+                self.post(batch, retry=not stopping)
+            if stopping:
+                break
+        self.close_connection()
+
+    def flush(self):
+        '''
+        Ask the worker to post whatever is waiting now
+        '''
+        with self.condition:
+            if self.pending:
+                self.oldest = time.time() - FLUSH_INTERVAL
+                self.condition.notify()
+
+    def stop(self, timeout=None):
+        '''
+        Post what is waiting, without retries, then end the worker
+        '''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join(timeout)
+
+    def post(self, batch, retry=True):
+        attempt = 0
+        while batch:
+            try:
+                batch = self.send(batch)
+            except (socket.error, httplib.HTTPException) as e:
+                self.close_connection()
+                if self.verbose:
+                    self.log.info("SERVER: unreachable ({0})".format(e))
+            if not batch or not retry or attempt >= MAX_RETRIES:
+                break
+            time.sleep(min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+            attempt += 1
+
+        if batch:
+            self.log.warning("CLIENT: {0} events not logged".format(len(batch)))
+        if self.dropped:
+            self.log.warning("CLIENT: {0} events dropped, queue full".format(self.dropped))
+            self.dropped = 0
+
+    def send(self, batch):
+        '''
+        Post a batch, returning the events which should be retried
+        '''
+        if self.bulk is not False:
+            retry = self.send_bulk(batch)
+            if retry is not None:
+                return retry
+        return [event for event in batch if not self.send_one(event)]
+
+    def send_bulk(self, batch):
+        '''
+        Post the batch to the bulk endpoint
+        Returns None if the server has no bulk endpoint
+        '''
+        body = '\n'.join([json.dumps(dict([(name.lower(), value) for name, value in event.items()]))
+                          for event in batch])
+        status, answer = self.request('POST', BULK_PATH, body, {'Content-Type': 'application/x-ndjson'})
+        if status in (404, 405) or (status == 200 and not answer.startswith('{')):
+            self.bulk = False
+            return None
+        self.bulk = True
+        if status == 503:
+            return batch
+        if status != 200:
+            self.log.warning("SERVER: {0} {1}".format(status, answer))
+            return []
+
+        result = json.loads(answer)
+        if self.verbose:
+            self.log.info("SERVER: {0} accepted, {1} rejected".format(result['accepted'], result['rejected']))
+        busy = set([error['line'] for error in result['errors'] if error['error'] == 'server is busy'])
+        return [event for line, event in enumerate(batch, 1) if line in busy]
+
+    def send_one(self, event):
+        '''
+        Post one event as headers; False if it should be retried
+        '''
+        status, answer = self.request('GET', '/', None, event)
+        if self.verbose:
+            self.log.info("SERVER: {0}".format(answer))
+        return status != 503
+
+    def request(self, method, path, body, headers):
+        '''
+        Issue a request over the reused connection
+        '''
+        if self.conn is None:
+            self.connect()
+        if self.proxy_headers:
+            headers = OrderedDict(headers)
+            headers.update(self.proxy_headers)
+        self.conn.request(method, self.prefix + path, body, headers)
+        response = self.conn.getresponse()
+        answer = response.read().strip()
+        if response.will_close:
+            self.close_connection()
+        return response.status, answer
+
+    def connect(self):
+        '''
+        Connect to the server, or to the HTTP proxy calibre.browser()
+        would use, unless the server is exempt through no_proxy
+        '''
+        parts = urlparse.urlsplit(self.url)
+        host, port = parts.hostname, parts.port or 80
+        proxy = get_parsed_proxy('http', debug=False)
+        if proxy and not urllib.proxy_bypass(host):
+            self.conn = httplib.HTTPConnection(proxy['host'], proxy['port'] or 80,
+                                               timeout=CONNECTION_TIMEOUT)
+            self.prefix = 'http://{0}:{1}'.format(host, port)
+            self.proxy_headers = {}
+            if proxy.get('user'):
+                credentials = '{0}:{1}'.format(proxy['user'], proxy.get('pass') or '')
+                self.proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        else:
+            self.conn = httplib.HTTPConnection(host, port, timeout=CONNECTION_TIMEOUT)
+            self.prefix = ''
+            self.proxy_headers = {}
+
+    def close_connection(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
 
 def main():
     '''
@@ -68,54 +287,45 @@ def main():
         format='%(asctime)s.%(msecs)d: %(message)s', datefmt='%H:%M:%S')
     log = logging.getLogger('client')
 
-    br = browser()
+    logger = PluginEventLogger.instance(verbose=True)
     try:
-        br.open(SERVER_URL)
         if False:
-            # Stress test: hit the server with 100 events per plugin in rapid succession
+            # Stress test: 100 events per plugin in rapid succession
             iterations = 100
             log.info("CLIENT: starting stress test with {0} iterations…".format(iterations))
-            DELAY = 0.01
             for x in range(iterations):
-                post = PluginEventLogger(plugin='Log latest', version=x, verbose=False)
-                post.req.add_header('CALIBRE_INSTALL_UUID', prefs['installation_uuid'])
-                post.start()
-                time.sleep(DELAY)
-
-                post = PluginEventLogger(plugin='Log all', version=x, verbose=False)
-                post.req.add_header('CALIBRE_INSTALL_UUID', prefs['installation_uuid'])
-                post.start()
-                time.sleep(DELAY)
-            log.info("CLIENT: stress test complete")
+                logger.log_event('Log latest', version=x,
+                                 CALIBRE_INSTALL_UUID=prefs['installation_uuid'])
+                logger.log_event('Log all', version=x,
+                                 CALIBRE_INSTALL_UUID=prefs['installation_uuid'])
+            log.info("CLIENT: stress test queued")
 
         # Post regular events
         if True:
             # Post a request to 'Log latest' which uses unique installation_id
             log.info("CLIENT: logging to 'Log latest'…")
-            post = PluginEventLogger(plugin="Log latest", version="1.2.3")
-            post.req.add_header('CALIBRE_INSTALL_UUID', prefs['installation_uuid'])
-            post.start()
+            logger.log_event("Log latest", version="1.2.3",
+                             CALIBRE_INSTALL_UUID=prefs['installation_uuid'])
 
             # Post a request to 'Log all' which uses unique installation_id
             log.info("CLIENT: logging to 'Log all'…")
-            post = PluginEventLogger(plugin="Log all", version="2.3.4")
-            post.req.add_header('CALIBRE_INSTALL_UUID', prefs['installation_uuid'])
-            post.start()
+            logger.log_event("Log all", version="2.3.4",
+                             CALIBRE_INSTALL_UUID=prefs['installation_uuid'])
 
         # Post a request for an unknown plugin
         if False:
             log.info("CLIENT: logging to 'Some other plugin'…")
-            post = PluginEventLogger(plugin="Some other plugin", version="0.0.1")
-            post.start()
+            logger.log_event("Some other plugin", version="0.0.1")
 
         # Post a request to a registered plugin with new fields
         if True:
-            post = PluginEventLogger(plugin='Log all', version="1.2.3")
-            post.req.add_header('CALIBRE_INSTALL_UUID', prefs['installation_uuid'])
-            post.req.add_header('PLUGIN_BOOK_COUNT', '50')
-            post.req.add_header('PLUGIN_SOME_OTHER_VALUE', 'abcde')
-            post.start()
+            logger.log_event('Log all', version="1.2.3",
+                             CALIBRE_INSTALL_UUID=prefs['installation_uuid'],
+                             PLUGIN_BOOK_COUNT='50',
+                             PLUGIN_SOME_OTHER_VALUE='abcde')
 
+        # Post everything now rather than waiting for FLUSH_INTERVAL
+        logger.stop()
 
     except:
         log.info("ERROR: Unable to reach server '{0}'".format(SERVER_URL))
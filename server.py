@@ -6,11 +6,17 @@
 __license__ = 'GPL v3'
 __copyright__ = '2014, Gregory Riker'
 
-import argparse, hashlib, json, logging, os, re, signal, socket, sqlite3
-import time, threading, urllib, SocketServer
+import argparse, asyncore, calendar, csv, glob, gzip, hashlib, httplib, itertools, json, logging, multiprocessing
+import os, re, shutil, signal, socket, sqlite3, struct, sys, time, threading, urllib, urlparse, zlib
+import Queue, SocketServer
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque, namedtuple, OrderedDict
 
 # Version for newly minted DBs
-CURRENT_DB_VERSION = 1
+# Bump it with each new SchemaUpgrade.upgrade_version_xx: DBs whose
+# checked_version in the registry has reached it skip the upgrade check
+CURRENT_DB_VERSION = 2
 DEVELOPMENT = True
 
 if DEVELOPMENT:
@@ -21,18 +27,185 @@ else:
     LOGGING_FOLDER = os.path.join(os.path.sep, 'path_to', 'plugin_logging', 'folder')
 
 COUNTRIES_DB = "Countries.db"
+COUNTRIES_TABLE = "Countries"
+COUNTRY_CACHE_SIZE = 65536
 REGISTERED_PLUGINS_DB = "Registered plugins.db"
 REGISTERED_PLUGINS_TABLE = "Registered plugins"
 
+# Optional registry columns, added to existing registries at startup
+# partition_period: 'day', 'month' or 'year' to store an append-only
+#   plugin (no unique_logins_field) in one DB file per period, e.g.
+#   "log_all_connections.2014-06.db"
+# keep_partitions: periods kept as live DBs, the current one included
+#   (NULL keeps all, at least 2 are kept)
+# expired_partitions: 'compress' (default) to vacuum and gzip older
+#   partitions, 'drop' to delete them
+# dedup_window: seconds during which repeats of a stored event (same
+#   install, plugin_version and calibre_version) are only counted, not
+#   written; the counts are added to logins every DEDUP_FLUSH_INTERVAL
+REGISTRY_COLUMNS = (
+    ('partition_period', 'TEXT'),
+    ('keep_partitions', 'INTEGER'),
+    ('expired_partitions', 'TEXT'),
+    ('dedup_window', 'INTEGER'),
+    # Set by the server: user_version of the plugin DB when last checked
+    ('checked_version', 'INTEGER'),
+    )
+PARTITION_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
+DEDUP_CACHE_SIZE = 200000
+DEDUP_FLUSH_INTERVAL = 30.0
+
+# Event fields a plugin has not registered are kept here as a JSON object
+EXTRAS_COLUMN = 'extras'
+# Seconds between log summaries of the unregistered fields received
+UNRECOGNIZED_REPORT_INTERVAL = 300.0
+
 INSERT_TEMPLATE = '''
     INSERT OR REPLACE INTO "{table_name}"
     ({columns})
     VALUES({values})'''
 
+# Plugins with a unique_logins_field store one row per unique value,
+# counting repeat events in logins
+UPSERT_TEMPLATE = '''
+    INSERT INTO "{table_name}"
+    ({columns})
+    VALUES({values})
+    ON CONFLICT("{unique_field}") DO UPDATE SET {updates}'''
+
+# Used when the DB cannot carry a unique index on unique_logins_field
+UPDATE_TEMPLATE = '''
+    UPDATE "{table_name}"
+    SET {updates}
+    WHERE "{unique_field}" = ?'''
+
+INDEX_TEMPLATE = '''
+    CREATE {unique}INDEX IF NOT EXISTS "{index_name}"
+    ON "{table_name}" ("{column}")'''
+
 TABLE_TEMPLATE = '''
     CREATE TABLE IF NOT EXISTS "{table_name}"
     ({columns})'''
 
+# Each plugin DB keeps daily rollups of its events alongside the raw table:
+# "<plugin> daily" counts events and distinct installs per day for every
+# combination of the ROLLUP_DIMENSIONS the plugin registers, and
+# "<plugin> daily installs" records the installs already counted
+ROLLUP_DIMENSIONS = ('plugin_version', 'calibre_version', 'calibre_os')
+ROLLUP_INSTALL_FIELD = 'calibre_install_uuid'
+ROLLUP_TABLE = "{0} daily"
+ROLLUP_INSTALLS_TABLE = "{0} daily installs"
+
+ROLLUP_TABLE_TEMPLATE = '''
+    CREATE TABLE IF NOT EXISTS "{rollup_table}"
+    (day TEXT NOT NULL, {dimension_columns},
+     events INTEGER NOT NULL DEFAULT 0, installs INTEGER NOT NULL DEFAULT 0,
+     PRIMARY KEY (day, {dimensions}))'''
+
+ROLLUP_INSTALLS_TABLE_TEMPLATE = '''
+    CREATE TABLE IF NOT EXISTS "{installs_table}"
+    (day TEXT NOT NULL, {dimension_columns}, install TEXT NOT NULL,
+     PRIMARY KEY (day, {dimensions}, install)) WITHOUT ROWID'''
+
+# A newly recorded install bumps its day's installs count
+ROLLUP_TRIGGER_TEMPLATE = '''
+    CREATE TRIGGER IF NOT EXISTS "{installs_table} count"
+    AFTER INSERT ON "{installs_table}"
+    BEGIN
+        INSERT OR IGNORE INTO "{rollup_table}" (day, {dimensions})
+        VALUES (NEW.day, {new_dimensions});
+        UPDATE "{rollup_table}" SET installs = installs + 1
+        WHERE day = NEW.day AND {match_new};
+    END'''
+
+# Applied to every long-lived plugin DB connection
+PLUGIN_DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-8192',
+    'PRAGMA temp_store=MEMORY',
+    )
+SQLITE_TIMEOUT = 10.0
+# Seconds the writer waits on a locked plugin DB before giving up on the
+# batch, which is then spooled, rather than holding every other plugin
+WRITE_BUSY_TIMEOUT = 0.2
+
+# Seconds a handler waits for its event to be committed in 'durable' ack mode
+WRITE_TIMEOUT = 30.0
+
+# Events the writer cannot take, or fails to store, are appended to spool
+# files in this subfolder of LOGGING_FOLDER and replayed once it has room
+SPOOL_FOLDER = "spool"
+SPOOL_REPLAY_INTERVAL = 1.0
+SPOOL_REPLAY_CHUNK = 1000
+
+# A relay (--relay) forwards batches to the upstream's BULK_PATH. After a
+# failed post it sends nothing for RELAY_RETRY seconds, doubled after each
+# further failure up to RELAY_MAX_RETRY, spooling events meanwhile
+RELAY_TIMEOUT = 30.0
+RELAY_RETRY = 1.0
+RELAY_MAX_RETRY = 60.0
+
+# HTTP request limits
+RECV_SIZE = 16384
+MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 16 * 1024 * 1024
+KEEPALIVE_TIMEOUT = 15.0
+EVENT_HEADER_PREFIXES = ('calibre_', 'plugin_')
+
+# Fields the server adds to every event. Stored only by plugins which
+# register them, never reported as unrecognized
+SERVER_FIELDS = ('originating_ip', 'country')
+
+# Share of the in-flight limit open to unregistered plugins and probes,
+# which are also turned away once the writer queue is half full
+PROBE_SHARE = 0.1
+
+# GET this path for live server statistics as JSON
+STATS_PATH = '/_stats'
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATS_SHARDS = 16
+
+# --export reads plugin DBs EXPORT_CHUNK rows at a time. An incremental
+# export stops EXPORT_SETTLE seconds short of now, so rows still being
+# committed are left for the next one
+EXPORT_FORMATS = ('ndjson', 'csv', 'columns')
+EXPORT_CHUNK = 1000
+EXPORT_SETTLE = 5
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Log records wait in a queue of this size for the thread writing them to
+# the log file and console; beyond it they are dropped and counted
+LOG_QUEUE_SIZE = 10000
+# Request handlers log through REQUEST_LOGGER, limited per call site to
+# LOG_BURST messages every LOG_RATE_INTERVAL seconds, then one in LOG_SAMPLE
+REQUEST_LOGGER = 'plugin_logger.requests'
+LOG_RATE_INTERVAL = 10.0
+LOG_BURST = 20
+LOG_SAMPLE = 100
+
+# POST newline-delimited JSON events here to log many in one request
+BULK_PATH = '/events'
+MAX_BULK_ERRORS = 100
+BUSY_ERROR = 'server is busy'
+# Answer to a line carrying relay fields from an address not in --trusted-relays
+UNTRUSTED_RELAY_ERROR = 'count and received are only accepted from --trusted-relays'
+RELAY_FIELDS = ('count', 'received')
+HTTP_STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+    }
+
 
 class SchemaUpgrade(object):
 
@@ -44,6 +217,10 @@ class SchemaUpgrade(object):
 
         self.log = log
         self.conn = conn
+        self.plugin = plugin
+        # sqlite3 commits before DDL, so run the upgrades in one explicit
+        # transaction
+        conn.isolation_level = None
         self.cursor = conn.cursor()
         self.cursor.execute('BEGIN EXCLUSIVE TRANSACTION')
 
@@ -59,6 +236,7 @@ class SchemaUpgrade(object):
                     meth()
                     self.cursor.execute('pragma user_version=%d'%(uv+1))
                     updates += 1
+            self.cursor.execute('COMMIT')
         except:
             import traceback
             self.log.error(traceback.format_exc())
@@ -70,21 +248,1864 @@ class SchemaUpgrade(object):
         if not updates:
             self.log.info("plugin '{0}' up to date".format(plugin))
 
-    def _upgrade_version_1(self):
+    def upgrade_version_1(self):
+        '''
+        Add the extras column holding unregistered event fields
+        '''
+        columns = [c[1] for c in
+                   self.cursor.execute('''PRAGMA table_info("{0}")'''.format(self.plugin)).fetchall()]
+        if columns and EXTRAS_COLUMN not in columns:
+            self.cursor.execute('''ALTER TABLE "{0}" ADD COLUMN {1} TEXT'''.format(self.plugin, EXTRAS_COLUMN))
+
+    def _upgrade_version_2(self):
         '''
         To enable this schema upgrade, remove leading underscore from method name
         '''
-        self.log.info("updating DB from version 1 to version 2")
+        self.log.info("updating DB from version 2 to version 3")
+
+
+class LRUCache(object):
+    '''
+    Bounded, thread-safe mapping which evicts the least recently used key
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class CountryIndex(object):
+    '''
+    Country IP ranges from Countries.db, searched with bisect
+    The "Countries" table holds (ip_from, ip_to, country) rows, addresses
+    as text ('1.2.3.0', '2001:db8::') or as IPv4 integers. Ranges must not
+    overlap. Starts and ends are kept in sorted arrays per address family,
+    with repeat lookups answered from an LRU cache. Rows which cannot be
+    parsed are skipped and counted.
+    '''
+
+    def __init__(self, v4, v6, skipped=0):
+        self.v4 = v4
+        self.v6 = v6
+        self.skipped = skipped
+        self.cache = LRUCache(COUNTRY_CACHE_SIZE)
+        self.miss = object()
+
+    def __len__(self):
+        return len(self.v4[0]) + len(self.v6[0])
+
+    @classmethod
+    def load(cls, countries_db):
+        v4, v6 = [], []
+        skipped = 0
+        if os.path.exists(countries_db):
+            conn = sqlite3.connect(countries_db)
+            try:
+                rows = conn.execute('''SELECT ip_from, ip_to, country
+                                        FROM "{0}"'''.format(COUNTRIES_TABLE)).fetchall()
+            finally:
+                conn.close()
+            for ip_from, ip_to, country in rows:
+                try:
+                    start, family = cls.address(ip_from)
+                    end, end_family = cls.address(ip_to)
+                except (socket.error, ValueError, TypeError, AttributeError, OverflowError):
+                    skipped += 1
+                    continue
+                if not country or family != end_family or end < start:
+                    skipped += 1
+                    continue
+                if isinstance(country, bytes):
+                    # Names like "Côte d'Ivoire" stay unicode
+                    country = intern(country)
+                (v4 if family == socket.AF_INET else v6).append((start, end, country))
+        v4.sort()
+        v6.sort()
+        return cls((array('L', [r[0] for r in v4]), array('L', [r[1] for r in v4]), [r[2] for r in v4]),
+                   ([r[0] for r in v6], [r[1] for r in v6], [r[2] for r in v6]), skipped)
+
+    @staticmethod
+    def address(ip):
+        '''
+        Return (integer, family) for an address
+        '''
+        if isinstance(ip, (int, long)):
+            return ip, socket.AF_INET
+        ip = ip.strip()
+        if ':' in ip:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+            if packed.startswith(b'\x00' * 10 + b'\xff\xff'):
+                # IPv4-mapped
+                return int(packed[12:].encode('hex'), 16), socket.AF_INET
+            return int(packed.encode('hex'), 16), socket.AF_INET6
+        return int(socket.inet_aton(ip).encode('hex'), 16), socket.AF_INET
+
+    def lookup(self, ip):
+        '''
+        Country for ip, or None
+        '''
+        if not len(self):
+            return None
+        country = self.cache.get(ip, self.miss)
+        if country is self.miss:
+            country = None
+            try:
+                n, family = self.address(ip)
+            except (socket.error, ValueError):
+                pass
+            else:
+                starts, ends, countries = self.v4 if family == socket.AF_INET else self.v6
+                i = bisect_right(starts, n) - 1
+                if i >= 0 and n <= ends[i]:
+                    country = countries[i]
+            self.cache.set(ip, country)
+        return country
+
+
+HTTPRequest = namedtuple('HTTPRequest', [
+    'method', 'path', 'query_string', 'version', 'headers', 'body', 'keep_alive'])
+
+Response = namedtuple('Response', ['status', 'body', 'headers'])
+
+
+class HTTPParseError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class HTTPRequestParser(object):
+    '''
+    Incremental HTTP/1.x request parser
+    feed() data as it arrives; next_request() returns each complete request
+    in turn, or None until the rest of it has been received
+    '''
+
+    def __init__(self):
+        self.buffer = ''
+        self.head = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        if self.head is None:
+            end = self.buffer.find('\r\n\r\n')
+            skip = 4
+            if end < 0:
+                # Tolerate bare newlines
+                end = self.buffer.find('\n\n')
+                skip = 2
+            if end < 0:
+                if len(self.buffer) > MAX_HEADER_BYTES:
+                    raise HTTPParseError(431, 'request headers too large')
+                return None
+            head = self.buffer[:end]
+            self.buffer = self.buffer[end + skip:]
+            self.head = self.parse_head(head)
+
+        method, path, query_string, version, headers, length = self.head
+        if len(self.buffer) < length:
+            return None
+        body = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        self.head = None
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        return HTTPRequest(method, path, query_string, version, headers, body, keep_alive)
+
+    def parse_head(self, head):
+        lines = head.lstrip('\r\n').split('\n')
+        request_line = lines[0].split()
+        if len(request_line) == 3:
+            method, target, version = request_line
+        elif len(request_line) == 2:
+            (method, target), version = request_line, 'HTTP/0.9'
+        else:
+            raise HTTPParseError(400, 'malformed request line')
+
+        path, _, query_string = target.partition('?')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+            raise HTTPParseError(411, 'chunked requests not supported, send Content-Length')
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPParseError(400, 'invalid Content-Length')
+        if length < 0:
+            raise HTTPParseError(400, 'invalid Content-Length')
+        if length > MAX_BODY_BYTES:
+            raise HTTPParseError(413, 'request body too large')
+        return (method.upper(), path, query_string or None, version.upper(), headers, length)
+
+
+def http_response(response, keep_alive):
+    '''
+    Serialize a Response as an HTTP/1.1 message
+    '''
+    status, body, headers = response
+    lines = ['HTTP/1.1 {0} {1}'.format(status, HTTP_STATUS.get(status, 'Unknown')),
+             'Content-Length: {0}'.format(len(body)),
+             'Connection: {0}'.format('keep-alive' if keep_alive else 'close')]
+    if not any(name.lower() == 'content-type' for name, value in headers):
+        lines.append('Content-Type: text/plain; charset=utf-8')
+    for name, value in headers:
+        lines.append('{0}: {1}'.format(name, value))
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+def utf8(value):
+    '''
+    Encode unicode, e.g. a country name, for byte string formats
+    '''
+    return value.encode('utf-8') if isinstance(value, type(u'')) else value
+
+
+RegisteredPlugin = namedtuple('RegisteredPlugin', [
+    'name', 'path', 'db_path', 'default_fields', 'field_order',
+    'unique_logins_field', 'db_exists',
+    'partition_period', 'keep_partitions', 'expired_partitions', 'dedup_window',
+    'checked_version'])
+
+
+def parse_timestamp(value):
+    '''
+    Normalize a UTC 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' to the latter,
+    the form of stored timestamps
+    '''
+    for format in (TIMESTAMP_FORMAT, '%Y-%m-%d'):
+        try:
+            return time.strftime(TIMESTAMP_FORMAT, time.strptime(value.strip(), format))
+        except ValueError:
+            pass
+    raise ValueError("'{0}' is not a YYYY-MM-DD[ HH:MM:SS] time".format(value))
+
+
+def partition_key(period, when):
+    '''
+    Name of the partition holding events received at when, e.g. '2014-06'
+    '''
+    return time.strftime(PARTITION_FORMATS[period], time.gmtime(when))
+
+
+def partition_cutoff(period, keep, now):
+    '''
+    Oldest partition key still within the keep most recent periods
+    '''
+    year, month = time.gmtime(now)[:2]
+    if period == 'day':
+        return partition_key(period, now - (keep - 1) * 86400)
+    if period == 'month':
+        months = year * 12 + month - 1 - (keep - 1)
+        return '{0:04d}-{1:02d}'.format(months // 12, months % 12 + 1)
+    return '{0:04d}'.format(year - keep + 1)
+
+
+def partition_path(db_path, key):
+    root, ext = os.path.splitext(db_path)
+    return "{0}.{1}{2}".format(root, key, ext)
+
+
+def partition_paths(db_path):
+    '''
+    Existing partitions of db_path as sorted (key, path, compressed) tuples
+    '''
+    root, ext = os.path.splitext(db_path)
+    pattern = re.compile(re.escape(root) + r'\.(\d{4}(?:-\d\d){0,2})' + re.escape(ext) + r'(\.gz)?$')
+    partitions = []
+    for path in glob.glob(root.replace('[', '[[]') + '.*'):
+        match = pattern.match(path)
+        if match:
+            partitions.append((match.group(1), path, bool(match.group(2))))
+    return sorted(partitions)
+
+
+class PluginRegistry(object):
+    '''
+    Read-only snapshot of the Registered plugins DB
+    Handlers never query the DB directly; a reload builds a new snapshot
+    which replaces the old one in a single assignment
+    '''
+
+    def __init__(self, plugins):
+        self.plugins = plugins
+
+    def __contains__(self, plugin):
+        return plugin in self.plugins
+
+    def __len__(self):
+        return len(self.plugins)
+
+    def get(self, plugin):
+        return self.plugins.get(plugin)
+
+    @classmethod
+    def load(cls, plugins_db):
+        '''
+        Read and parse every registered plugin once
+        '''
+        conn = sqlite3.connect(plugins_db)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute('''SELECT * FROM "{0}"'''.format(REGISTERED_PLUGINS_TABLE)).fetchall()
+        finally:
+            conn.close()
+
+        plugins = {}
+        for row in rows:
+            # Registries not yet upgraded lack the REGISTRY_COLUMNS
+            row = dict(zip(row.keys(), tuple(row)))
+            db_path = os.path.join(LOGGING_FOLDER, row[b'path'])
+            period = cls.partition_period(row)
+            plugins[row[b'plugin_name']] = RegisteredPlugin(
+                name=row[b'plugin_name'],
+                path=row[b'path'],
+                db_path=db_path,
+                default_fields=json.loads(row[b'default_fields']),
+                field_order=tuple(json.loads(row[b'field_order'])),
+                unique_logins_field=row[b'unique_logins_field'],
+                # The writer creates partitions as it needs them
+                db_exists=period is not None or os.path.exists(db_path),
+                partition_period=period,
+                keep_partitions=row.get(b'keep_partitions'),
+                expired_partitions=row.get(b'expired_partitions') or 'compress',
+                dedup_window=row.get(b'dedup_window') or 0,
+                checked_version=row.get(b'checked_version'))
+        return cls(plugins)
+
+    @staticmethod
+    def partition_period(row):
+        '''
+        Only append-only plugins with a known period are partitioned
+        '''
+        period = row.get(b'partition_period')
+        if period in PARTITION_FORMATS and not row[b'unique_logins_field']:
+            return period
+        return None
+
+
+InsertPlan = namedtuple('InsertPlan', [
+    'keys', 'extra', 'insert', 'update', 'unique_index', 'extras'])
+
+Rollup = namedtuple('Rollup', [
+    'dimensions', 'install_field', 'add_group', 'count_events', 'add_install'])
+
+
+class PluginDB(object):
+    '''
+    Long-lived connection to one plugin DB, shared by all handler threads
+    Callers hold self.lock around any use of self.conn
+    '''
+
+    def __init__(self, plugin, db_path):
+        self.plugin = plugin
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        for pragma in PLUGIN_DB_PRAGMAS:
+            self.conn.execute(pragma)
+        # Set by ensure_indexes(): True if logins can be bumped with an upsert
+        self.upsert = None
+        # Set by ensure_rollup(): the Rollup maintained on each write, or
+        # False if the plugin registers no ROLLUP_DIMENSIONS
+        self.rollup = None
+        # InsertPlans keyed by the frozenset of an event's registered fields
+        # and whether it has others, built for the registry entry in
+        # self.plans_for. Unregistered names are chosen by clients, so they
+        # stay out of the key and the cache stays bounded.
+        self.plans = {}
+        self.plans_for = None
+        # Set on the first write: True if the table has EXTRAS_COLUMN
+        self.extras = None
+        # False for a short-lived connection to a partition other than the
+        # current one, which its user closes; release runs on close()
+        self.managed = True
+        self.release = None
+
+    def invalidate_plans(self):
+        '''
+        Forget compiled plans after a registry or schema change
+        '''
+        self.plans = {}
+        self.plans_for = None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+    def ensure_indexes(self, unique_logins_field, log):
+        '''
+        Index unique_logins_field so each event is a single indexed write
+        A unique index enables the upsert; if existing rows already hold
+        duplicate values, fall back to a plain index
+        '''
+        with self.lock:
+            if unique_logins_field is None:
+                self.upsert = False
+                return
+            if self.unique_index_exists(unique_logins_field):
+                self.upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+                return
+
+            args = {'unique': 'UNIQUE ',
+                    'index_name': "{0} {1}".format(self.plugin, unique_logins_field),
+                    'table_name': self.plugin,
+                    'column': unique_logins_field}
+            try:
+                with self.conn:
+                    self.conn.execute(INDEX_TEMPLATE.format(**args))
+                self.upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+            except sqlite3.IntegrityError:
+                log.warning("WARNING: '{0}' has duplicate {1} values, login counts use a plain index".format(
+                    self.plugin, unique_logins_field))
+                args['unique'] = ''
+                with self.conn:
+                    self.conn.execute(INDEX_TEMPLATE.format(**args))
+                self.upsert = False
+            self.invalidate_plans()
+
+    def ensure_rollup(self, default_fields, log):
+        '''
+        Create the daily rollup tables if missing, backfilling them from
+        the rows already stored
+        Dimensions are fixed when the tables are created; fields registered
+        later are not rolled up
+        '''
+        with self.lock:
+            rollup_table = ROLLUP_TABLE.format(self.plugin)
+            columns = [c[b'name'] for c in
+                       self.conn.execute('''PRAGMA table_info("{0}")'''.format(rollup_table)).fetchall()]
+            created = not columns
+            if created:
+                dimensions = [d for d in ROLLUP_DIMENSIONS if d in default_fields]
+            else:
+                dimensions = [d for d in ROLLUP_DIMENSIONS if d in columns]
+            if not dimensions:
+                self.rollup = False
+                return
+
+            installs_table = ROLLUP_INSTALLS_TABLE.format(self.plugin)
+            if ROLLUP_INSTALL_FIELD in default_fields or self.table_exists(installs_table):
+                install_field = ROLLUP_INSTALL_FIELD
+            else:
+                install_field = None
+            match = " AND ".join(["{0} = ?".format(d) for d in dimensions])
+            args = {'rollup_table': rollup_table,
+                    'installs_table': installs_table,
+                    'dimensions': ", ".join(dimensions),
+                    'dimension_columns': ", ".join(["{0} TEXT NOT NULL".format(d) for d in dimensions]),
+                    'new_dimensions': ", ".join(["NEW.{0}".format(d) for d in dimensions]),
+                    'match_new': " AND ".join(["{0} = NEW.{0}".format(d) for d in dimensions])}
+            self.rollup = Rollup(
+                dimensions=tuple(dimensions),
+                install_field=install_field,
+                add_group='''INSERT OR IGNORE INTO "{0}" (day, {1}) VALUES (?, {2})'''.format(
+                    rollup_table, args['dimensions'], ", ".join(['?' for d in dimensions])),
+                count_events='''UPDATE "{0}" SET events = events + ? WHERE day = ? AND {1}'''.format(
+                    rollup_table, match),
+                add_install='''INSERT OR IGNORE INTO "{0}" (day, {1}, install) VALUES (?, {2}, ?)'''.format(
+                    installs_table, args['dimensions'], ", ".join(['?' for d in dimensions])))
+
+            # sqlite3 commits before DDL, so manage the transaction here to
+            # create and backfill the tables atomically
+            isolation_level = self.conn.isolation_level
+            self.conn.isolation_level = None
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self.conn.execute(ROLLUP_TABLE_TEMPLATE.format(**args))
+                    if install_field:
+                        self.conn.execute(ROLLUP_INSTALLS_TABLE_TEMPLATE.format(**args))
+                        self.conn.execute(ROLLUP_TRIGGER_TEMPLATE.format(**args))
+                    if created:
+                        self.backfill_rollup(log)
+                    self.conn.execute('COMMIT')
+                except:
+                    self.conn.execute('ROLLBACK')
+                    raise
+            finally:
+                self.conn.isolation_level = isolation_level
+
+    def backfill_rollup(self, log):
+        '''
+        Roll up the rows stored before the rollup tables existed
+        Plugins keeping one row per install only hold each install's
+        latest event, so their earlier days are undercounted
+        '''
+        columns = [c[b'name'] for c in
+                   self.conn.execute('''PRAGMA table_info("{0}")'''.format(self.plugin)).fetchall()]
+        if 'timestamp' not in columns:
+            return
+        fields = [d for d in self.rollup.dimensions if d in columns]
+        if self.rollup.install_field in columns:
+            fields.append(self.rollup.install_field)
+        cur = self.conn.execute('''SELECT date(timestamp) AS day{0} FROM "{1}"
+                                   WHERE timestamp IS NOT NULL'''.format(
+                                   "".join([", " + f for f in fields]), self.plugin))
+        rows = 0
+        while True:
+            chunk = cur.fetchmany(1000)
+            if not chunk:
+                break
+            self.update_rollup(self.conn.cursor(), [dict(zip(fields, tuple(row)[1:])) for row in chunk],
+                               [row[0] for row in chunk])
+            rows += len(chunk)
+        if rows:
+            log.info("rolled up {0} existing '{1}' rows".format(rows, self.plugin))
+
+    def update_rollup(self, cur, events, days, counts=None):
+        '''
+        Add events, received on the matching days, to the rollup tables
+        counts, if given, is how many times each event occurred
+        Events are counted per (day, dimensions) group, so each group
+        costs one statement however many events it holds
+        '''
+        rollup = self.rollup
+        groups = OrderedDict()
+        installs = set()
+        for i, (event, day) in enumerate(zip(events, days)):
+            group = (day,) + tuple([event.get(d) or '' for d in rollup.dimensions])
+            groups[group] = groups.get(group, 0) + (counts[i] if counts is not None else 1)
+            if rollup.install_field:
+                install = event.get(rollup.install_field)
+                if install:
+                    installs.add(group + (install,))
+        cur.executemany(rollup.add_group, list(groups.keys()))
+        cur.executemany(rollup.count_events, [(n,) + group for group, n in groups.items()])
+        if installs:
+            cur.executemany(rollup.add_install, list(installs))
+
+    def table_exists(self, table):
+        return self.conn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?''',
+                                 (table,)).fetchone() is not None
+
+    def unique_index_exists(self, column):
+        for index in self.conn.execute('''PRAGMA index_list("{0}")'''.format(self.plugin)).fetchall():
+            if not index[b'unique']:
+                continue
+            columns = self.conn.execute('''PRAGMA index_info("{0}")'''.format(index[b'name'])).fetchall()
+            if [c[b'name'] for c in columns] == [column]:
+                return True
+        return False
+
+    def write_events(self, authorized, events, days, log):
+        '''
+        Store a batch of events, received on the matching days, and their
+        rollups in a single transaction
+        Events sharing a column set are written with one executemany
+        Returns how many events carried each unrecognized key
+        '''
+        if self.upsert is None:
+            self.ensure_indexes(authorized.unique_logins_field, log)
+        if self.rollup is None:
+            self.ensure_rollup(authorized.default_fields, log)
+        if self.extras is None:
+            with self.lock:
+                self.extras = EXTRAS_COLUMN in [c[b'name'] for c in self.conn.execute(
+                    '''PRAGMA table_info("{0}")'''.format(self.plugin)).fetchall()]
+        if self.plans_for is not authorized:
+            self.invalidate_plans()
+            self.plans_for = authorized
+        plans = self.plans
+        default_fields = authorized.default_fields
+
+        batches = OrderedDict()
+        unknown_keys = Counter()
+        for event in events:
+            known, unknown = [], []
+            for key in event:
+                if key in default_fields:
+                    known.append(key)
+                elif key != 'calibre_plugin' and key not in SERVER_FIELDS:
+                    unknown.append(key)
+            unknown_keys.update(unknown)
+            fields = (frozenset(known), bool(unknown))
+            plan = plans.get(fields)
+            if plan is None:
+                plan = plans[fields] = self.plan(authorized, *fields)
+            values = tuple([event[key] for key in plan.keys])
+            if plan.extras:
+                values += (json.dumps(dict([(key, event[key]) for key in unknown]),
+                                      sort_keys=True, separators=(',', ':')),)
+            values += plan.extra
+            rows = batches.get(plan)
+            if rows is None:
+                rows = batches[plan] = []
+            rows.append(values)
+
+        with self.lock:
+            cur = self.conn.cursor()
+            with self.conn:
+                for plan, rows in batches.items():
+                    if plan.update is None:
+                        cur.executemany(plan.insert, rows)
+                        continue
+
+                    # No unique index: update the existing row, else insert
+                    for row in rows:
+                        if plan.unique_index is not None:
+                            cur.execute(plan.update, row + (row[plan.unique_index],))
+                            if cur.rowcount:
+                                continue
+                        cur.execute(plan.insert, row)
+                if self.rollup:
+                    self.update_rollup(cur, events, days)
+        return unknown_keys
+
+    def write_repeats(self, authorized, events, days, counts, log):
+        '''
+        Record repeats of stored events which the dedup window kept out
+        of the DB: bump logins (and the timestamp) of their rows, and
+        count them in the rollup
+        '''
+        if self.upsert is None:
+            self.ensure_indexes(authorized.unique_logins_field, log)
+        if self.rollup is None:
+            self.ensure_rollup(authorized.default_fields, log)
+        unique_logins_field = authorized.unique_logins_field
+        with self.lock:
+            cur = self.conn.cursor()
+            with self.conn:
+                if unique_logins_field:
+                    touch = ''
+                    if 'timestamp' in authorized.default_fields:
+                        touch = ', timestamp = CURRENT_TIMESTAMP'
+                    cur.executemany('''UPDATE "{0}" SET logins = logins + ?{1} WHERE "{2}" = ?'''.format(
+                                    authorized.name, touch, unique_logins_field),
+                                    [(n, event[unique_logins_field]) for event, n in zip(events, counts)
+                                     if event.get(unique_logins_field) is not None])
+                if self.rollup:
+                    self.update_rollup(cur, events, days, counts)
+
+    def plan(self, authorized, fields, unknown):
+        '''
+        Compile the statement storing events which carry these registered
+        fields, and unregistered ones if unknown
+        '''
+        default_fields = authorized.default_fields
+        unique_logins_field = authorized.unique_logins_field
+        event_keys = tuple(sorted(fields))
+        # Unregistered fields go to the extras column, if the DB has one
+        extras = unknown and self.extras and EXTRAS_COLUMN not in default_fields
+        statement = self.statement(authorized, event_keys + ((EXTRAS_COLUMN,) if extras else ()))
+        if isinstance(statement, tuple):
+            insert, update = statement
+        else:
+            insert, update = statement, None
+        return InsertPlan(
+            keys=event_keys,
+            # Login count for a new row, or the increment for an existing one
+            extra=(1,) if unique_logins_field else (),
+            insert=insert,
+            update=update,
+            unique_index=event_keys.index(unique_logins_field) if unique_logins_field in event_keys else None,
+            extras=extras)
+
+    def statement(self, authorized, event_keys):
+        '''
+        SQL storing an event with the given fields
+        '''
+        unique_logins_field = authorized.unique_logins_field
+        columns = list(event_keys)
+        if unique_logins_field:
+            columns.append('logins')
+        args = {'table_name': authorized.name,
+                'columns': ", ".join(columns),
+                'values': ", ".join(['?' for c in columns])}
+        if not unique_logins_field:
+            if not columns:
+                # An event carrying no registered field
+                return 'INSERT INTO "{table_name}" DEFAULT VALUES'.format(**args)
+            return INSERT_TEMPLATE.format(**args)
+
+        # A repeat event refreshes the supplied fields and bumps logins
+        refreshed = [key for key in event_keys if key != unique_logins_field]
+        if 'timestamp' in authorized.default_fields and 'timestamp' not in event_keys:
+            touch = ['timestamp = CURRENT_TIMESTAMP']
+        else:
+            touch = []
+        args['unique_field'] = unique_logins_field
+        if self.upsert:
+            args['updates'] = ", ".join(["{0} = excluded.{0}".format(key) for key in refreshed] +
+                                        ['logins = logins + excluded.logins'] + touch)
+            return UPSERT_TEMPLATE.format(**args)
+
+        # Parameters follow the insert's order: event fields, then logins
+        args['updates'] = ", ".join(["{0} = ?".format(key) for key in event_keys] +
+                                    ['logins = logins + ?'] + touch)
+        return (INSERT_TEMPLATE.format(**args), UPDATE_TEMPLATE.format(**args))
+
+
+PendingEvent = namedtuple('PendingEvent', ['plugin', 'event', 'received', 'callback'])
+
+
+class DedupWindow(object):
+    '''
+    Events stored recently by plugins with a dedup_window, keyed by
+    (plugin, install, plugin_version, calibre_version)
+    A repeat inside the window is counted instead of written; take()
+    hands the counts to the writer. Beyond size entries, the oldest are
+    forgotten, so their next repeat is written.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        # key: time the window ends
+        self.entries = OrderedDict()
+        # (key, day): [repeats, latest PendingEvent]
+        self.counts = OrderedDict()
+        self.flushed = time.time()
+
+    @staticmethod
+    def key(pending):
+        event = pending.event
+        return (pending.plugin, event.get(ROLLUP_INSTALL_FIELD),
+                event.get('plugin_version'), event.get('calibre_version'))
+
+    def repeat(self, pending, window):
+        '''
+        True if pending repeats an event stored within the window
+        '''
+        key = self.key(pending)
+        if key[1] is None:
+            return False
+        ends = self.entries.get(key)
+        if ends is not None and ends > pending.received:
+            day = time.strftime('%Y-%m-%d', time.gmtime(pending.received))
+            count = self.counts.get((key, day))
+            if count is None:
+                self.counts[(key, day)] = [1, pending]
+            else:
+                count[0] += 1
+                count[1] = pending
+            return True
+        if ends is not None:
+            del self.entries[key]
+        self.entries[key] = pending.received + window
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return False
+
+    def forget(self, pending):
+        '''
+        Drop the entry for an event which could not be stored
+        '''
+        self.entries.pop(self.key(pending), None)
+
+    def due(self, now):
+        return bool(self.counts) and (now - self.flushed >= DEDUP_FLUSH_INTERVAL or
+                                      len(self.counts) >= self.size)
+
+    def take(self):
+        '''
+        Counted repeats since the last take, as (latest PendingEvent, repeats)
+        '''
+        counts = self.counts
+        self.counts = OrderedDict()
+        self.flushed = time.time()
+        return [(pending, n) for n, pending in counts.values()]
+
+
+class Completion(object):
+    '''
+    Callback which records its result for a waiting thread
+    '''
+
+    def __init__(self, default=False):
+        self.done = threading.Event()
+        self.result = default
+
+    def __call__(self, result):
+        self.result = result
+        self.done.set()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.result
+
+
+class EventWriter(threading.Thread):
+    '''
+    Single writer stage between the handlers and the plugin DBs
+    Handlers queue events; this thread drains the queue and commits each
+    plugin's share of a batch in one transaction. A batch is flushed when
+    batch_size events are waiting or batch_latency seconds have passed
+    since its first event arrived.
+    '''
+
+    def __init__(self, parent, queue_size, batch_size, batch_latency, durable, queue=None):
+        threading.Thread.__init__(self, name='EventWriter')
+        self.daemon = True
+        self.parent = parent
+        self.log = parent.log
+        self.queue = queue if queue is not None else Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.durable = durable
+        self.dedup = DedupWindow(DEDUP_CACHE_SIZE)
+        # (plugin, key): events carrying an unregistered key since the last
+        # report_unrecognized()
+        self.unrecognized = Counter()
+        self.unrecognized_due = time.time() + UNRECOGNIZED_REPORT_INTERVAL
+
+    def submit(self, pending, block=False):
+        '''
+        Queue an event for writing; False if the queue is full
+        '''
+        try:
+            self.queue.put(pending, block)
+        except Queue.Full:
+            return False
+        return True
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def capacity(self):
+        return self.queue.maxsize
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            try:
+                # Wake up to flush counted repeats even when idle
+                pending = self.queue.get(timeout=DEDUP_FLUSH_INTERVAL
+                                         if self.dedup.counts or self.unrecognized else None)
+            except Queue.Empty:
+                self.flush_repeats()
+                if time.time() >= self.unrecognized_due:
+                    self.report_unrecognized()
+                continue
+            if pending is None:
+                break
+            batch = [pending]
+            deadline = time.time() + self.batch_latency
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self.queue.get_nowait()
+                except Queue.Empty:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        pending = self.queue.get(timeout=remaining)
+                    except Queue.Empty:
+                        break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self.commit(batch)
+        self.flush_repeats()
+        self.report_unrecognized()
+
+    def commit(self, batch):
+        '''
+        Write one batch, one transaction per plugin, then run the callbacks
+        '''
+        by_plugin = OrderedDict()
+        for pending in batch:
+            by_plugin.setdefault(pending.plugin, []).append(pending)
+
+        registry = self.parent.registry
+        for plugin, pendings in by_plugin.items():
+            authorized = registry.get(plugin)
+            if authorized is not None and authorized.dedup_window:
+                pendings = self.suppress_repeats(authorized, pendings)
+            if authorized is not None and authorized.partition_period:
+                partitions = OrderedDict()
+                for pending in pendings:
+                    key = partition_key(authorized.partition_period, pending.received)
+                    partitions.setdefault(key, []).append(pending)
+                groups = partitions.values()
+            else:
+                groups = [pendings]
+
+            for pendings in groups:
+                ok = authorized is not None and self.write(authorized, pendings)
+                for pending in pendings:
+                    if not ok and authorized is not None and authorized.dedup_window:
+                        self.dedup.forget(pending)
+                    if pending.callback is not None:
+                        pending.callback(ok)
+
+        now = time.time()
+        if self.dedup.due(now):
+            self.flush_repeats()
+        if now >= self.unrecognized_due:
+            self.report_unrecognized()
+
+    def report_unrecognized(self):
+        '''
+        Log how many events carried each unregistered key since the last
+        report, rather than a warning per event
+        '''
+        self.unrecognized_due = time.time() + UNRECOGNIZED_REPORT_INTERVAL
+        if not self.unrecognized:
+            return
+        by_plugin = OrderedDict()
+        for (plugin, key), n in sorted(self.unrecognized.items()):
+            by_plugin.setdefault(plugin, []).append("{0} ({1})".format(key, n))
+        self.unrecognized.clear()
+        self.log.info("unrecognized keys: {0}".format("; ".join(
+            ["'{0}' {1}".format(plugin, ", ".join(keys)) for plugin, keys in by_plugin.items()])))
+
+    def suppress_repeats(self, authorized, pendings):
+        '''
+        Acknowledge repeats inside the plugin's dedup window without
+        writing them; returns the events to write
+        '''
+        fresh = []
+        for pending in pendings:
+            if self.dedup.repeat(pending, authorized.dedup_window):
+                self.parent.stats.count('deduplicated', authorized.name)
+                if pending.callback is not None:
+                    pending.callback(True)
+            else:
+                fresh.append(pending)
+        return fresh
+
+    def flush_repeats(self):
+        '''
+        Add the repeats counted by the dedup window to their plugin DBs
+        '''
+        groups = OrderedDict()
+        registry = self.parent.registry
+        for pending, n in self.dedup.take():
+            authorized = registry.get(pending.plugin)
+            if authorized is None:
+                continue
+            partition = None
+            if authorized.partition_period:
+                partition = partition_key(authorized.partition_period, pending.received)
+            groups.setdefault((pending.plugin, partition), []).append((pending, n))
+
+        for (plugin, _), repeats in groups.items():
+            authorized = registry.get(plugin)
+            try:
+                db = self.parent.plugin_db(authorized, repeats[0][0].received)
+                try:
+                    db.write_repeats(authorized, [pending.event for pending, n in repeats],
+                                     [time.strftime('%Y-%m-%d', time.gmtime(pending.received))
+                                      for pending, n in repeats],
+                                     [n for pending, n in repeats], self.log)
+                finally:
+                    if not db.managed:
+                        db.close()
+            except Exception as e:
+                import traceback
+                self.log.error(traceback.format_exc())
+                self.log.error("Error: {0} ({1} repeats in '{2}' not counted)".format(
+                    e, sum([n for pending, n in repeats]), plugin))
+
+    def write(self, authorized, pendings):
+        '''
+        Store events bound for one plugin DB or partition
+        '''
+        if not pendings:
+            return True
+        try:
+            if not authorized.db_exists:
+                self.parent.create_missing_db(authorized)
+            db = self.parent.plugin_db(authorized, pendings[0].received)
+            try:
+                unknown_keys = db.write_events(
+                    authorized, [p.event for p in pendings],
+                    [time.strftime('%Y-%m-%d', time.gmtime(p.received)) for p in pendings], self.log)
+            finally:
+                if not db.managed:
+                    db.close()
+        except Exception as e:
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                # Past WRITE_BUSY_TIMEOUT; the events are spooled
+                self.log.warning("WARNING: '{0}' is locked, {1} events not stored".format(
+                    authorized.name, len(pendings)))
+                return False
+            import traceback
+            self.log.error(traceback.format_exc())
+            self.log.error("Error: {0} ({1} events in '{2}' not stored)".format(
+                e, len(pendings), authorized.name))
+            return False
+        for key, n in unknown_keys.items():
+            self.unrecognized[(authorized.name, key)] += n
+        return True
+
+    def stop(self):
+        '''
+        Flush whatever is queued, then exit
+        '''
+        self.queue.put(None)
+        self.join()
+
+
+def writer_index(plugin, writers):
+    '''
+    The writer process owning a plugin's DB
+    '''
+    if not isinstance(plugin, bytes):
+        plugin = plugin.encode('utf-8')
+    return int(hashlib.md5(plugin).hexdigest(), 16) % writers
+
+
+class RoutedEventWriter(EventWriter):
+    '''
+    EventWriter run by a writer process, fed by every worker process
+    through one multiprocessing queue
+    Events carry (worker, serial) tokens instead of callbacks; results go
+    back on the workers' reply queues, one message per worker per batch
+    '''
+
+    def __init__(self, parent, queue, replies, batch_size, batch_latency):
+        EventWriter.__init__(self, parent, 0, batch_size, batch_latency, True, queue=queue)
+        self.replies = replies
+
+    def commit(self, batch):
+        results = {}
+
+        def acknowledge(token):
+            worker, serial = token
+            return lambda ok: results.setdefault(worker, []).append((serial, ok))
+
+        EventWriter.commit(self, [pending._replace(callback=acknowledge(pending.callback))
+                                  if pending.callback is not None else pending
+                                  for pending in batch])
+        for worker, acks in results.items():
+            self.replies[worker].put(acks)
+
+
+class WriterClient(object):
+    '''
+    Stands in for the EventWriter in a worker process
+    Each event is queued to the writer process owning its plugin; in
+    'durable' ack mode its callback runs when the writer's reply arrives
+    Every event gets a reply, so events in flight are counted per writer
+    here: multiprocessing.Queue.qsize() is not implemented on macOS
+    '''
+
+    def __init__(self, queues, replies, worker, queue_size, durable):
+        self.queues = queues
+        self.replies = replies
+        self.worker = worker
+        self.queue_size = queue_size
+        self.durable = durable
+        # serial: (writer index, callback or None)
+        self.callbacks = {}
+        self.inflight = [0] * len(queues)
+        self.lock = threading.Lock()
+        self.serials = itertools.count()
+        self.receiver = threading.Thread(target=self.receive, name='WriterReplies')
+        self.receiver.daemon = True
+
+    def start(self):
+        self.receiver.start()
+
+    def submit(self, pending, block=False):
+        '''
+        Queue an event for its writer; False if that writer's queue is full
+        '''
+        index = writer_index(pending.plugin, len(self.queues))
+        token = (self.worker, next(self.serials))
+        with self.lock:
+            self.callbacks[token[1]] = (index, pending.callback)
+            self.inflight[index] += 1
+        try:
+            self.queues[index].put(pending._replace(callback=token), block)
+        except Queue.Full:
+            with self.lock:
+                del self.callbacks[token[1]]
+                self.inflight[index] -= 1
+            return False
+        return True
+
+    def qsize(self):
+        return sum(self.inflight)
+
+    def capacity(self):
+        return self.queue_size * len(self.queues)
+
+    def receive(self):
+        while True:
+            acks = self.replies.get()
+            if acks is None:
+                break
+            for serial, ok in acks:
+                with self.lock:
+                    index, callback = self.callbacks.pop(serial, (None, None))
+                    if index is not None:
+                        self.inflight[index] -= 1
+                if callback is not None:
+                    callback(ok)
+
+    def stop(self):
+        '''
+        Wait for outstanding results, then end the reply thread
+        '''
+        deadline = time.time() + WRITE_TIMEOUT
+        while self.callbacks and time.time() < deadline:
+            time.sleep(0.05)
+        self.replies.put(None)
+        self.receiver.join()
+
+
+class RelayWriter(EventWriter):
+    '''
+    Writer stage of a relay: forwards each batch to the upstream server
+    instead of storing it
+    Identical events in a batch are posted once with their count, as
+    gzipped newline-delimited JSON. While the upstream is failing, batches
+    fail at once and are spooled; retry_at is when it is tried again.
+    '''
+
+    def __init__(self, parent, url, queue_size, batch_size, interval, durable):
+        EventWriter.__init__(self, parent, queue_size, batch_size, interval, durable)
+        self.name = 'RelayWriter'
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip('/') + BULK_PATH
+        self.conn = None
+        self.failures = 0
+        self.retry_at = 0
+
+    def commit(self, batch):
+        '''
+        Forward a batch, then run the callbacks
+        '''
+        lines = OrderedDict()
+        for pending in batch:
+            key = (pending.plugin, tuple(sorted(pending.event.items())))
+            lines.setdefault(key, []).append(pending)
+        lines = list(lines.values())
+        if time.time() >= self.retry_at:
+            failed = self.forward(lines)
+        else:
+            failed = dict([(line_number, len(pendings)) for line_number, pendings in enumerate(lines, 1)])
+        for line_number, pendings in enumerate(lines, 1):
+            # The first failed[line_number] events of a line are retried
+            for i, pending in enumerate(pendings):
+                if pending.callback is not None:
+                    pending.callback(i >= failed.get(line_number, 0))
+
+    def forward(self, lines):
+        '''
+        Post lines of identical events
+        Returns {line number: how many of its events to retry}
+        '''
+        body = '\n'.join([json.dumps(dict(pendings[0].event, received=pendings[0].received, count=len(pendings)))
+                          for pendings in lines])
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+        try:
+            status, answer = self.post(body)
+            if status != 200:
+                raise httplib.HTTPException("{0} {1}".format(status, answer.strip()))
+            result = json.loads(answer)
+        except (socket.error, httplib.HTTPException, ValueError) as e:
+            self.close()
+            self.back_off(str(e) or e.__class__.__name__)
+            return dict([(line_number, len(pendings)) for line_number, pendings in enumerate(lines, 1)])
+
+        failed = {}
+        dropped = 0
+        untrusted = False
+        for error in result['errors']:
+            line_number = error['line']
+            pendings = lines[line_number - 1]
+            if error['error'] == BUSY_ERROR:
+                failed[line_number] = min(len(pendings), failed.get(line_number, 0) + error.get('failed', 1))
+            elif error['error'] == UNTRUSTED_RELAY_ERROR:
+                failed[line_number] = len(pendings)
+                untrusted = True
+            else:
+                dropped += len(pendings)
+                self.log.warning("WARNING: upstream rejected {0} '{1}' events: {2}".format(
+                    len(pendings), pendings[0].plugin, error['error']))
+        if untrusted:
+            # Keep the events until the upstream is configured
+            self.back_off("this relay is not in its --trusted-relays")
+            return dict([(line_number, len(pendings)) for line_number, pendings in enumerate(lines, 1)])
+        if self.failures:
+            self.log.info("upstream {0} reachable again".format(self.url))
+            self.failures = 0
+        sent = sum([len(pendings) for pendings in lines])
+        expected = sent - sum(failed.values()) - dropped
+        if result['accepted'] != expected:
+            self.log.error("Error: upstream accepted {0} of {1} events sent, {2} expected".format(
+                result['accepted'], sent, expected))
+        return failed
+
+    def back_off(self, reason):
+        '''
+        Send nothing upstream for a while, longer after each failure
+        '''
+        delay = min(RELAY_MAX_RETRY, RELAY_RETRY * 2 ** self.failures)
+        self.failures += 1
+        self.retry_at = time.time() + delay
+        self.log.warning("WARNING: upstream {0} failed ({1}), retrying in {2:g}s".format(
+            self.url, reason, delay))
+
+    def post(self, body):
+        '''
+        POST a gzipped body to the upstream over the kept-alive connection
+        '''
+        while True:
+            reused = self.conn is not None
+            if not reused:
+                self.conn = httplib.HTTPConnection(self.host, self.port, timeout=RELAY_TIMEOUT)
+            try:
+                self.conn.request('POST', self.path, body, {'Content-Type': 'application/x-ndjson',
+                                                             'Content-Encoding': 'gzip'})
+                response = self.conn.getresponse()
+                answer = response.read()
+            except (socket.error, httplib.HTTPException):
+                self.close()
+                # The upstream closes idle connections: retry on a new one
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                self.close()
+            return response.status, answer
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stop(self):
+        EventWriter.stop(self)
+        self.close()
+
+
+class Spool(object):
+    '''
+    Append-only files of events waiting to be replayed to the writer
+    Each record is a 4-byte big-endian length and a JSON event. Appends
+    are fsynced in groups: whoever syncs covers every record written
+    before it, so concurrent appends share one fsync.
+    rotate() closes the current file; closed files are replayed, then
+    removed. append_later() spools from a thread of its own, for callers
+    such as the async event loop which must not wait for the disk.
+    '''
+
+    def __init__(self, folder, name, max_bytes, log):
+        self.folder = folder
+        self.name = name
+        self.max_bytes = max_bytes
+        self.log = log
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.file = None
+        self.written = 0
+        self.synced = 0
+        self.appender = None
+        self.appends = Queue.Queue()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # Bytes spooled and not yet replayed
+        self.size = sum([os.path.getsize(path) for path in self.segments(folder, name)])
+
+    @staticmethod
+    def segments(folder, name='*'):
+        '''
+        Spool files in the order they were started
+        '''
+        paths = glob.glob(os.path.join(folder, '{0}.*.spool'.format(name)))
+        return sorted(paths, key=lambda path: int(path.rsplit('.', 2)[-2]))
+
+    @staticmethod
+    def read(path, log):
+        '''
+        Yield the events in a spool file, stopping at a torn final record
+        '''
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(4)
+                if not header:
+                    break
+                record = f.read(struct.unpack('>I', header)[0]) if len(header) == 4 else b''
+                try:
+                    fields = json.loads(record)
+                except ValueError:
+                    log.warning("WARNING: incomplete record at the end of '{0}' skipped".format(
+                        os.path.basename(path)))
+                    break
+                yield PendingEvent(fields['plugin'], fields['event'], fields['received'], None)
+
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def append(self, pendings):
+        '''
+        Spool events; True once they are on disk
+        '''
+        data = b''.join([struct.pack('>I', len(record)) + record for record in
+                         [json.dumps({'plugin': p.plugin, 'event': p.event, 'received': p.received})
+                          for p in pendings]])
+        try:
+            with self.lock:
+                if self.size + len(data) > self.max_bytes:
+                    return False
+                if self.file is None:
+                    path = os.path.join(self.folder, '{0}.{1}.spool'.format(self.name, int(time.time() * 1000000)))
+                    self.file = open(path, 'ab')
+                self.file.write(data)
+                self.written += len(data)
+                self.size += len(data)
+                written = self.written
+            self.sync(written)
+        except (IOError, OSError) as e:
+            self.log.error("Error: {0} ({1} events not spooled)".format(e, len(pendings)))
+            return False
+        return True
+
+    def append_later(self, pendings, callback):
+        '''
+        Spool events on the appender thread; callback(ok) runs there
+        '''
+        with self.lock:
+            if self.appender is None:
+                self.appender = threading.Thread(target=self.run_appends, name='SpoolAppender')
+                self.appender.daemon = True
+                self.appender.start()
+        self.appends.put((pendings, callback))
+
+    def run_appends(self):
+        while True:
+            item = self.appends.get()
+            if item is None:
+                break
+            pendings, callback = item
+            callback(self.append(pendings))
+
+    def sync(self, written):
+        with self.sync_lock:
+            if self.synced >= written:
+                return
+            with self.lock:
+                self.file.flush()
+                written = self.written
+            os.fsync(self.file.fileno())
+            self.synced = written
+
+    def rotate(self):
+        '''
+        Close the current file; returns this spool's files, all now closed
+        '''
+        with self.sync_lock:
+            with self.lock:
+                if self.file is not None:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.file.close()
+                    self.file = None
+                    self.synced = self.written
+        return self.segments(self.folder, self.name)
+
+    def remove(self, path):
+        with self.lock:
+            self.size = max(0, self.size - os.path.getsize(path))
+            os.remove(path)
+
+    def close(self):
+        if self.appender is not None:
+            self.appends.put(None)
+            self.appender.join()
+        self.rotate()
+
+
+class SpoolReplayer(threading.Thread):
+    '''
+    Feed spooled events back to the writer whenever its queue is less
+    than half full, and a relay's upstream is not known to be down
+    A spool file is removed once each of its events has been stored or,
+    failing that, spooled again
+    '''
+
+    def __init__(self, parent, spool):
+        threading.Thread.__init__(self, name='SpoolReplayer')
+        self.daemon = True
+        self.parent = parent
+        self.log = parent.log
+        self.spool = spool
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SPOOL_REPLAY_INTERVAL):
+            writer = self.parent.writer
+            if (self.spool.size and writer.qsize() * 2 < writer.capacity() and
+                    time.time() >= getattr(writer, 'retry_at', 0)):
+                self.replay(self.spool.rotate())
+
+    def replay(self, paths):
+        for path in paths:
+            try:
+                self.replay_file(path)
+            except Exception as e:
+                import traceback
+                self.log.error(traceback.format_exc())
+                self.log.error("Error: {0} (replaying '{1}')".format(e, os.path.basename(path)))
+                break
+
+    def replay_file(self, path):
+        replayed = respooled = dropped = 0
+        events = Spool.read(path, self.log)
+        while True:
+            chunk = list(itertools.islice(events, SPOOL_REPLAY_CHUNK))
+            if not chunk:
+                break
+            waiting = []
+            for pending in chunk:
+                if pending.plugin not in self.parent.registry:
+                    dropped += 1
+                    continue
+                done = Completion()
+                self.parent.writer.submit(pending._replace(callback=done), block=True)
+                waiting.append((pending, done))
+            for pending, done in waiting:
+                if done.wait():
+                    replayed += 1
+                elif self.spool.append([pending]):
+                    respooled += 1
+                else:
+                    # Keep the file: its stored events will be stored again
+                    raise IOError("spool is full")
+        self.spool.remove(path)
+        self.log.info("replayed {0} spooled events, {1} spooled again, {2} for unregistered plugins dropped".format(
+            replayed, respooled, dropped))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
 
-class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
+class StatsShard(object):
 
-    def __init__(self, parent, *args, **keys):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+
+class ServerStats(object):
+    '''
+    Counters and latency histograms for the request path
+    Each thread records into one of STATS_SHARDS shards, so recording only
+    contends with the few threads sharing its shard; snapshot() merges them.
+    Stages: parse, registry, store, respond, and request (end to end)
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.shards = [StatsShard() for i in range(STATS_SHARDS)]
+        self.next_shard = itertools.count()
+        self.local = threading.local()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.shards[next(self.next_shard) % STATS_SHARDS]
+            return shard
+
+    def count(self, group, name, n=1):
+        shard = self.shard()
+        key = (group, name)
+        with shard.lock:
+            shard.counters[key] = shard.counters.get(key, 0) + n
+
+    def record(self, stage, seconds):
+        shard = self.shard()
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with shard.lock:
+            histogram = shard.histograms.get(stage)
+            if histogram is None:
+                # Bucket counts, then the sum of all samples
+                histogram = shard.histograms[stage] = [0] * (len(LATENCY_BUCKETS) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self):
+        '''
+        Merge the shards: ({(group, name): n}, {stage: histogram})
+        '''
+        counters, histograms = {}, {}
+        for shard in self.shards:
+            with shard.lock:
+                for key, n in shard.counters.items():
+                    counters[key] = counters.get(key, 0) + n
+                for stage, histogram in shard.histograms.items():
+                    merged = histograms.setdefault(stage, [0] * len(histogram))
+                    for i, n in enumerate(histogram):
+                        merged[i] += n
+        return counters, histograms
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        '''
+        Upper bound (seconds) of the bucket holding the given fraction
+        '''
+        total = sum(histogram[:-1])
+        if not total:
+            return 0.0
+        running = 0
+        for i, n in enumerate(histogram[:-1]):
+            running += n
+            if running >= total * fraction:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+
+    def report(self, parent, previous=None):
+        '''
+        Statistics as a dict, covering the time since the previous report
+        if one is given, else the whole uptime
+        Returns (report, state to pass as previous next time)
+        '''
+        now = time.time()
+        totals = self.snapshot()
+        counters, histograms = totals
+        since = self.started
+        if previous is not None:
+            since, (previous_counters, previous_histograms) = previous
+            counters = dict([(key, n - previous_counters.get(key, 0)) for key, n in counters.items()])
+            # Deltas go in a new dict: totals is the next report's previous
+            deltas = {}
+            for stage, histogram in histograms.items():
+                before = previous_histograms.get(stage, [0] * len(histogram))
+                deltas[stage] = [n - b for n, b in zip(histogram, before)]
+            histograms = deltas
+        elapsed = max(now - since, 0.001)
+
+        stages = {}
+        for stage, histogram in histograms.items():
+            count = sum(histogram[:-1])
+            stages[stage] = {'count': count,
+                             'mean_ms': round(histogram[-1] / count * 1000, 3) if count else 0,
+                             'p50_ms': self.percentile(histogram, 0.50) * 1000,
+                             'p95_ms': self.percentile(histogram, 0.95) * 1000,
+                             'p99_ms': self.percentile(histogram, 0.99) * 1000}
+        groups = {}
+        for (group, name), n in counters.items():
+            groups.setdefault(group, {})[name] = n
+        events = {}
+        for plugin, n in groups.get('events', {}).items():
+            events[plugin] = {'count': n, 'per_second': round(n / elapsed, 2)}
+
+        server = getattr(parent, 'server', None)
+        report = {'uptime': round(now - self.started, 1),
+                  'connections': server.active_connections() if server is not None else 0,
+                  'inflight': parent.admission.inflight,
+                  'queue_depth': parent.writer.qsize(),
+                  'threads': threading.active_count(),
+                  'stages': stages,
+                  'events': events,
+                  'rejected': groups.get('rejected', {}),
+                  'deduplicated': groups.get('deduplicated', {}),
+                  'spooled': groups.get('spooled', {}),
+                  'spool_bytes': parent.spool.size if getattr(parent, 'spool', None) is not None else 0}
+        return report, (now, totals)
+
+
+class StatsReporter(threading.Thread):
+    '''
+    Log a one-line statistics summary every interval seconds
+    '''
+
+    def __init__(self, parent, interval):
+        threading.Thread.__init__(self, name='StatsReporter')
+        self.daemon = True
+        self.parent = parent
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        previous = None
+        while not self.stopped.wait(self.interval):
+            report, previous = self.parent.stats.report(self.parent, previous)
+            request = report['stages'].get('request', {})
+            store = report['stages'].get('store', {})
+            self.parent.log.info(
+                "stats: {0:.1f} events/s, request p50/p99 {1}/{2} ms, store p99 {3} ms, "
+                "{4} connections, {5} queued, {6} rejected".format(
+                    sum([e['per_second'] for e in report['events'].values()]),
+                    request.get('p50_ms', 0), request.get('p99_ms', 0), store.get('p99_ms', 0),
+                    report['connections'], report['queue_depth'],
+                    sum(report['rejected'].values())))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class LogQueue(logging.Handler):
+    '''
+    Handler queueing records for one background thread, which passes them
+    to the handlers writing the log file and console, so logging never
+    blocks on I/O. When the queue is full, records are dropped and counted.
+    Stop it before forking and start() it again on both sides: the thread
+    does not survive a fork.
+    '''
+
+    def __init__(self, handlers, size):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.size = size
+        self.queue = None
+        self.thread = None
+        self.dropped = 0
+
+    def start(self):
+        self.createLock()
+        if self.queue is None:
+            self.queue = Queue.Queue(self.size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='LogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.deliver(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "WARNING: {0} log messages dropped, log queue full".format(dropped)}))
+            self.deliver(record)
+
+    def deliver(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def stop(self):
+        '''
+        Write out the queued records, then end the thread
+        '''
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Pass the first burst records from each call site every interval
+    seconds, then one in sample; records at ERROR or above always pass
+    A record passed after others were held back notes how many
+    '''
+
+    def __init__(self, interval, burst, sample):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.sample = sample
+        self.lock = threading.Lock()
+        # (pathname, lineno): [window start, records in window, held back]
+        self.sites = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            state = self.sites.get(site)
+            if state is None:
+                state = self.sites[site] = [record.created, 0, 0]
+            elif record.created - state[0] >= self.interval:
+                state[0], state[1] = record.created, 0
+            state[1] += 1
+            over = state[1] - self.burst
+            if over > 0 and over % self.sample:
+                state[2] += 1
+                return False
+            held, state[2] = state[2], 0
+        if held:
+            record.msg = "{0} ({1} similar messages suppressed)".format(record.getMessage(), held)
+            record.args = ()
+        return True
+
+
+class AdmissionControl(object):
+    '''
+    Bounds the requests in flight between arrival and response
+    Requests for registered plugins may use every slot; unregistered
+    plugins and address probes get PROBE_SHARE of them. Over the limit, or
+    with the writer queue (and spool, if any) full, requests are turned
+    away at once with a 503 and a Retry-After hint.
+    '''
+
+    def __init__(self, max_inflight, writer, retry_after, spool=None):
+        self.max_inflight = max_inflight
+        self.probe_limit = max(1, int(max_inflight * PROBE_SHARE))
+        self.writer = writer
+        self.retry_after = retry_after
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.inflight = 0
+
+    def admit(self, registered):
+        '''
+        Claim a slot; the caller must release() it if admitted
+        '''
+        queued, capacity = self.writer.qsize(), self.writer.capacity()
+        if registered:
+            limit = self.max_inflight
+            full = queued >= capacity and (self.spool is None or self.spool.full())
+        else:
+            limit = self.probe_limit
+            full = queued * 2 >= capacity
+        if full:
+            return False
+        with self.lock:
+            if self.inflight >= limit:
+                return False
+            self.inflight += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def releasing(self, respond):
+        '''
+        Wrap respond so that answering the request releases its slot
+        Only the first response is sent, so the slot is released once
+        '''
+        answered = []
+        lock = threading.Lock()
+
+        def released(response):
+            with lock:
+                if answered:
+                    return
+                answered.append(response)
+            self.release()
+            respond(response)
+        return released
+
+    def busy_response(self):
+        return Response(503, "server is busy", [('Retry-After', str(self.retry_after))])
+
+
+class BulkResult(object):
+    '''
+    Tally of a bulk request; responds once every queued event is settled
+    Lines whose events the writer could not take are all listed, each
+    with how many of its events failed, so they can be retried; other
+    errors stop at MAX_BULK_ERRORS
+    '''
+
+    def __init__(self, respond, stats):
+        self.respond = respond
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+        # line: events of the line which failed
+        self.busy = OrderedDict()
+        self.outstanding = 1
+
+    def reject(self, line, error):
+        self.stats.count('rejected', 'bulk')
+        with self.lock:
+            self.rejected += 1
+            if len(self.errors) < MAX_BULK_ERRORS:
+                self.errors.append({'line': line, 'error': error})
+
+    def expect(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def settled(self, line, plugin, ok):
+        if ok:
+            self.stats.count('events', plugin)
+            with self.lock:
+                self.accepted += 1
+        else:
+            self.stats.count('rejected', 'bulk')
+            with self.lock:
+                self.rejected += 1
+                self.busy[line] = self.busy.get(line, 0) + 1
+        self.release()
+
+    def release(self):
+        with self.lock:
+            self.outstanding -= 1
+            done = self.outstanding == 0
+        if done:
+            busy = [{'line': line, 'error': BUSY_ERROR, 'failed': n} for line, n in self.busy.items()]
+            body = json.dumps({'accepted': self.accepted,
+                               'rejected': self.rejected,
+                               'errors': self.errors + busy})
+            self.respond(Response(200, body, [('Content-Type', 'application/json')]))
+
+
+class PluginEventMixin(object):
+    '''
+    Request handling shared by the threaded and async server engines
+    The engine supplies the request data and a respond callable, which
+    receives the response exactly once, possibly from the writer thread
+    '''
+    # True where handlers run on an event loop, which must not fsync
+    defer_spool = False
+
+    def init_handler(self, parent, client_address):
         self.db_path = None
+        self.registered = None
         self.countries_db_path = os.path.join(LOGGING_FOLDER, COUNTRIES_DB)
-        self.log = logging.getLogger('plugin_logger')
+        self.log = logging.getLogger(REQUEST_LOGGER)
         self.parent = parent
-        SocketServer.BaseRequestHandler.__init__(self, *args, **keys)
+        self.client_address = client_address
 
     def add_new_table(self, plugin):
         '''
@@ -105,10 +2126,11 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         ans += "timestamp DATETIME, logins INTEGER"
         args['columns'] = ans
 
-        conn = sqlite3.connect(self.db_path)
-        conn.execute(TABLE_TEMPLATE.format(**args))
+        db = self.parent.plugin_db(self.registered)
+        with db.lock:
+            db.conn.execute(TABLE_TEMPLATE.format(**args))
 
-    def handle(self):
+    def process(self, request, respond, started=None):
         '''
         GET / HTTP/1.1\r\nAccept-Encoding: identity\r\n
         Calibre_Version: 1.29.0\r\n
@@ -118,175 +2140,596 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         Connection: close\r\n
         Calibre_Os: osx\r\n\r\n
         '''
-        cur_thread = threading.current_thread()
-        self.data = self.request.recv(1024)
-        self.parse_header()
+        stats = self.parent.stats
+        if started is None:
+            started = time.time()
+        if request.path == STATS_PATH:
+            report, _ = stats.report(self.parent)
+            respond(Response(200, json.dumps(report, sort_keys=True),
+                             [('Content-Type', 'application/json')]))
+            return
+
+        admission = self.parent.admission
+        if request.path == BULK_PATH:
+            if admission.admit(True):
+                self.admitted(self.process_bulk, request, respond)
+            else:
+                stats.count('rejected', 'busy')
+                respond(admission.busy_response())
+            return
+
+        self.parse_header(request)
         plugin = self.event.get('calibre_plugin')
+        if not admission.admit(plugin in self.parent.registry):
+            stats.count('rejected', 'busy')
+            respond(admission.busy_response())
+            return
+        self.admitted(self.process_event, request, respond, started)
+
+    def admitted(self, handler, request, respond, *args):
+        '''
+        Run handler for an admitted request; its slot is released when it
+        responds, or with a 500 if it raises
+        '''
+        respond = self.parent.admission.releasing(respond)
+        try:
+            handler(request, respond, *args)
+        except Exception:
+            import traceback
+            self.log.error(traceback.format_exc())
+            respond(Response(500, "internal server error", ()))
+
+    def process_event(self, request, respond, started):
+        '''
+        Log the event carried by the headers parsed in process()
+        '''
+        stats = self.parent.stats
+        plugin = self.event.get('calibre_plugin')
+        cur_thread = threading.current_thread()
+        self.locate(self.event)
+        parsed = time.time()
+        stats.record('parse', parsed - started)
 
         if False:
             self.log.info("Handling request from {0} in thread {1}, {2} active threads".format(
-                self.event['country'], cur_thread.name, threading.active_count()))
+                utf8(self.event.get('country')), cur_thread.name, threading.active_count()))
 
         if plugin is not None:
-            if self.plugin_db_registered(plugin):
-                if self.store_event():
-                    self.request.sendall("event logged to '{0}'".format(plugin))
-                else:
-                    self.request.sendall("server is busy")
+            registered = self.plugin_db_registered(plugin)
+            checked = time.time()
+            stats.record('registry', checked - parsed)
+            if registered:
+                def stored(ok):
+                    stats.record('store', time.time() - checked)
+                    if ok:
+                        stats.count('events', plugin)
+                        respond(Response(200, "event logged to '{0}'".format(plugin), ()))
+                    else:
+                        stats.count('rejected', 'store_failed')
+                        respond(self.parent.admission.busy_response())
+                self.store_event(stored)
             else:
+                stats.count('rejected', 'unregistered')
                 self.log.info("request to log unregistered plugin '{0}' from {1} ({2})".format(
-                    plugin, self.event.get('originating_ip'), self.event.get('country')))
-                self.request.sendall("unregistered plugin '{0}', event not logged".format(plugin))
+                    plugin, self.event.get('originating_ip'), utf8(self.event.get('country'))))
+                respond(Response(403, "unregistered plugin '{0}', event not logged".format(plugin), ()))
         else:
-            self.request.sendall(self.client_address[0])
+            respond(Response(200, self.client_address[0], ()))
+
+    def process_bulk(self, request, respond):
+        '''
+        POST /events with one JSON object per line, e.g.
+        {"calibre_plugin": "Log all", "plugin_version": "1.2.3", "calibre_os": "Linux"}
+        Each event may name a different plugin. Field names follow the
+        CALIBRE_/PLUGIN_ headers and are case-insensitive.
+        Responds with {"accepted": n, "rejected": n, "errors": [...]}
+        '''
+        if request.method != 'POST':
+            respond(Response(405, "POST newline-delimited JSON events to {0}".format(BULK_PATH),
+                             [('Allow', 'POST')]))
+            return
+
+        body = request.body
+        encoding = request.headers.get('content-encoding', 'identity').lower()
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, MAX_BODY_BYTES)
+            except zlib.error as e:
+                respond(Response(400, "invalid gzip body: {0}".format(e), ()))
+                return
+            if decompressor.unconsumed_tail:
+                respond(Response(413, "request body too large", ()))
+                return
+        elif encoding != 'identity':
+            respond(Response(415, "unsupported Content-Encoding '{0}'".format(encoding), ()))
+            return
+
+        result = BulkResult(respond, self.parent.stats)
+        registry = self.parent.registry
+        # Relays forward each event's address, arrival time and repeat count
+        relayed = self.client_address[0] in self.parent.trusted_relays
+        for line_number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    raise ValueError('not a JSON object')
+            except ValueError as e:
+                result.reject(line_number, 'invalid JSON: {0}'.format(e))
+                continue
+            if not relayed and [name for name in RELAY_FIELDS if name in fields]:
+                # Storing the line once would silently drop its count
+                result.reject(line_number, UNTRUSTED_RELAY_ERROR)
+                continue
+
+            event = {}
+            for name, value in fields.items():
+                name = name.lower()
+                if name.startswith(EVENT_HEADER_PREFIXES):
+                    if isinstance(value, (dict, list)):
+                        break
+                    event[name] = value
+            else:
+                plugin = event.get('calibre_plugin')
+                if plugin is None:
+                    result.reject(line_number, 'missing calibre_plugin')
+                    continue
+                authorized = registry.get(plugin)
+                if authorized is None:
+                    result.reject(line_number, u"unregistered plugin '{0}'".format(plugin))
+                    continue
+                received, count = None, 1
+                if relayed:
+                    received, count = fields.get('received'), fields.get('count', 1)
+                    if not isinstance(received, (int, float)):
+                        received = None
+                    if not isinstance(count, int) or count < 1:
+                        result.reject(line_number, 'invalid count')
+                        continue
+                    self.locate(event, fields.get('originating_ip'))
+                else:
+                    self.locate(event)
+                for i in range(count):
+                    result.expect()
+                    self.queue_event(event, lambda ok, line_number=line_number, plugin=plugin:
+                                     result.settled(line_number, plugin, ok), received)
+                continue
+            result.reject(line_number, 'field values must be scalars')
+        result.release()
+
+    def locate(self, event, ip=None):
+        '''
+        Stamp the client's (or the given) address and country on an event
+        '''
+        ip = ip or self.client_address[0]
+        event['originating_ip'] = ip
+        event['country'] = self.parent.countries.lookup(ip)
 
-    def parse_header(self):
+    def parse_header(self, request):
         '''
-        Parse header lines for CALIBRE_ or PLUGIN_
-        Populates a dict of {field: value} from matching lines
+        Pick the CALIBRE_ or PLUGIN_ headers out of a parsed request
+        Populates a dict of {field: value} from matching headers
         '''
-        self.event = {}
-        pattern = re.compile(r"(?P<field>(CALIBRE_|PLUGIN_).*?): (?P<value>.*?)$", re.IGNORECASE)
-        _lines = self.data.splitlines()
-        lines = [line for line in _lines if line.strip()]
-        for line in lines:
-            matches = pattern.match(line)
-            if matches:
-                self.event[matches.groupdict()['field'].lower()] = matches.groupdict()['value']
+        self.event = dict([(name, value) for name, value in request.headers.items()
+                           if name.startswith(EVENT_HEADER_PREFIXES)])
 
         # Get appended query
-        self.query_string = None
-        if lines:
-            try:
-                method, path, _ = lines[0].split()
-                path = path.lstrip('/')
-                if '?' in path:
-                    self.query_string = path.split('?')[1]
-            except:
-                pass
+        self.query_string = request.query_string
 
-    def store_event(self):
+    def store_event(self, callback):
         """
-        Store the (populated) event data to the db
+        Hand the (populated) event data to the writer
+        callback(stored) runs once the event is queued ('accepted' ack mode)
+        or once the writer has committed it ('durable' ack mode)
         """
-        stored = False
-        if self.event.get('calibre_plugin') is not None:
-            plugin = self.event.get('calibre_plugin')
-
-            # Get the unique_logins_field for the plugin
-            ap_conn = sqlite3.connect(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB))
-            ap_conn.row_factory = sqlite3.Row
-            ap_cur = ap_conn.cursor()
-            ap_cur.execute('''SELECT default_fields, unique_logins_field
-                              FROM "{0}"
-                              WHERE plugin_name = "{1}"'''.format(
-                              REGISTERED_PLUGINS_TABLE, plugin))
-            row = ap_cur.fetchone()
-            unique_logins_field = row[b'unique_logins_field']
-            default_fields = json.loads(row[b'default_fields'])
-            ap_conn.close()
-
-            plugin_conn = sqlite3.connect(self.db_path)
-            plugin_conn.row_factory = sqlite3.Row
+        self.queue_event(self.event, callback)
+
+    def queue_event(self, event, callback, received=None):
+        plugin = event.get('calibre_plugin')
+        if plugin is None:
+            callback(False)
+            return
+        writer = self.parent.writer
+        spool = self.parent.spool
+        received = received or time.time()
+        if spool is None:
+            pending = PendingEvent(plugin, event, received,
+                                   callback if writer.durable else None)
+            if not writer.submit(pending):
+                callback(False)
+            elif not writer.durable:
+                callback(True)
+            return
+
+        # Events the writer cannot take or fails to store are spooled,
+        # and acknowledged once on disk
+        stats = self.parent.stats
+
+        def counted(ok):
+            if ok:
+                stats.count('spooled', plugin)
+            return ok
+
+        def stored(ok):
+            if not ok:
+                ok = counted(spool.append([pending]))
+            if writer.durable:
+                callback(ok)
+        pending = PendingEvent(plugin, event, received, stored)
+        if writer.submit(pending):
+            if not writer.durable:
+                callback(True)
+        elif self.defer_spool:
+            spool.append_later([pending], lambda ok: callback(counted(ok)))
+        else:
+            callback(counted(spool.append([pending])))
+
+    def plugin_db_registered(self, plugin):
+        '''
+        Confirm the plugin is registered
+        A missing DB is recreated by the writer, off the request path
+        '''
+        ans = False
+        if plugin is not None:
+            authorized = self.parent.registry.get(plugin)
+            if authorized:
+                self.registered = authorized
+                self.db_path = authorized.db_path
+                ans = True
+        return ans
+
+
+class ThreadedTCPRequestHandler(PluginEventMixin, SocketServer.BaseRequestHandler):
+
+    def __init__(self, parent, request, client_address, server):
+        self.init_handler(parent, client_address)
+        SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
+
+    def handle(self):
+        '''
+        Serve requests from this connection until the client closes it,
+        asks for Connection: close, or stays idle past KEEPALIVE_TIMEOUT
+        '''
+        self.request.settimeout(KEEPALIVE_TIMEOUT)
+        parser = HTTPRequestParser()
+        while True:
+            started = time.time()
             try:
-                # Previous logins from unique_logins_field?
-                cur = plugin_conn.cursor()
-                if unique_logins_field is not None:
-                    cur.execute('''SELECT logins FROM "{0}"
-                                   WHERE "{1}" = "{2}"'''.format(
-                                   plugin,
-                                   unique_logins_field,
-                                   self.event.get(unique_logins_field)))
-                    row = cur.fetchone()
-                else:
-                    row = None
+                request = parser.next_request()
+            except HTTPParseError as e:
+                self.parent.stats.count('rejected', 'bad_request')
+                self.request.sendall(http_response(Response(e.status, str(e), ()), False))
+                return
+
+            if request is None:
+                try:
+                    data = self.request.recv(RECV_SIZE)
+                except (socket.timeout, socket.error):
+                    return
+                if not data:
+                    return
+                parser.feed(data)
+                continue
+
+            response = Completion(default=self.parent.admission.busy_response())
+            self.process(request, response, started)
+            answer = http_response(response.wait(WRITE_TIMEOUT), request.keep_alive)
+            responding = time.time()
+            self.request.sendall(answer)
+            self.parent.stats.record('respond', time.time() - responding)
+            self.parent.stats.record('request', time.time() - started)
+            if not request.keep_alive:
+                return
 
-                # Bump the login count
-                if row:
-                    logins = row[b'logins'] + 1
-                else:
-                    logins = 1
 
-                # Construct the args for this entry
-                _event_keys = list(self.event.keys())
-                _event_keys.remove('calibre_plugin')
-                event_keys = [key for key in _event_keys if key in default_fields.keys()]
-                unknown_keys = [key for key in _event_keys if key not in default_fields.keys()]
+class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
 
-                event_keys.sort()
-                columns = ", ".join(event_keys)
-                values = ", ".join(['?' for e in event_keys])
-                if unique_logins_field:
-                    columns += ', logins'
-                    values += ', ?'
+    def __init__(self, server_address, RequestHandlerClass, parent, max_connections, listener=None):
+        self.parent = parent
+        self.max_connections = max_connections
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass,
+                                        bind_and_activate=listener is None)
+        if listener is not None:
+            # Worker process: accept on the socket shared by all workers
+            self.socket.close()
+            self.socket = listener
+
+    def process_request(self, request, client_address):
+        '''
+        Turn the connection away without starting a thread when at the limit
+        '''
+        with self.connections_lock:
+            admitted = self.connections < self.max_connections
+            if admitted:
+                self.connections += 1
+        if admitted:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        else:
+            self.parent.stats.count('rejected', 'connections')
+            try:
+                request.sendall(http_response(self.parent.admission.busy_response(), False))
+            except socket.error:
+                pass
+            self.shutdown_request(request)
 
-                args = {'table_name': plugin,
-                        'columns': columns,
-                        'values': values}
+    def active_connections(self):
+        return self.connections
 
-                values_template = INSERT_TEMPLATE.format(**args)
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
+
+
+class AsyncEventChannel(PluginEventMixin, asyncore.dispatcher):
+    '''
+    One client connection served by the async engine's event loop
+    Pipelined requests are answered one at a time, in order
+    '''
+    defer_spool = True
+
+    def __init__(self, parent, server, sock, client_address):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.init_handler(parent, client_address)
+        self.server = server
+        self.parser = HTTPRequestParser()
+        self.out_buffer = ''
+        self.busy = False
+        self.closing = False
+        self.keep_alive = False
+        self.last_active = time.time()
+
+    def handle_read(self):
+        data = self.recv(RECV_SIZE)
+        if not data:
+            return
+        self.last_active = time.time()
+        self.parser.feed(data)
+        self.next_request()
+
+    def next_request(self):
+        if self.busy or self.closing:
+            return
+        started = time.time()
+        try:
+            request = self.parser.next_request()
+        except HTTPParseError as e:
+            self.parent.stats.count('rejected', 'bad_request')
+            self.closing = True
+            self.out_buffer += http_response(Response(e.status, str(e), ()), False)
+            return
+        if request is None:
+            return
+        self.busy = True
+        self.keep_alive = request.keep_alive
+        self.started = started
+        self.process(request, lambda response: self.server.post(self, (response, time.time())), started)
+
+    def readable(self):
+        return not self.closing
+
+    def respond(self, posted):
+        '''
+        Called on the event loop thread once the response is ready
+        '''
+        response, ready = posted
+        now = time.time()
+        self.parent.stats.record('respond', now - ready)
+        self.parent.stats.record('request', now - self.started)
+        self.out_buffer += http_response(response, self.keep_alive)
+        self.busy = False
+        self.last_active = time.time()
+        if self.keep_alive:
+            self.next_request()
+        else:
+            self.closing = True
 
-                # Construct a list of values to be inserted in the table
-                values = []
-                for key in event_keys:
-                    values.append(self.event[key])
+    def writable(self):
+        return bool(self.out_buffer)
 
-                # Add the logins count if we're tracking logins
-                if unique_logins_field:
-                    values.append(logins)
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+        if not self.out_buffer and self.closing:
+            self.close()
 
-                with plugin_conn:
-                    cur.execute(values_template, tuple(values))
-                stored = True
+    def idle_since(self, cutoff):
+        return not self.busy and not self.out_buffer and self.last_active < cutoff
 
-                for key in unknown_keys:
-                    self.log.warning("WARNING: unrecognized key '{0}' ignored".format(key))
+    def handle_close(self):
+        self.close()
 
-            except Exception as e:
-                import traceback
-                self.log.error(traceback.format_exc())
-                self.log.error("Error: {0} ({1} active threads)".format(e, threading.active_count()))
-        return stored
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.server.connection_closed(self)
 
-    def plugin_db_registered(self, plugin):
+    def handle_error(self):
+        import traceback
+        self.log.error(traceback.format_exc())
+        self.close()
+
+
+class AsyncWakeup(asyncore.file_dispatcher):
+    '''
+    Self-pipe which wakes the event loop when another thread posts a response
+    '''
+
+    def __init__(self, server):
+        self.read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map=server.map)
+        self.server = server
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, b'x')
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        self.server.deliver_posted()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class AsyncTCPServer(asyncore.dispatcher):
+    '''
+    Single-threaded event loop engine with a connection limit
+    Blocking DB work stays on the writer thread; responses it completes
+    are posted back to the loop through a self-pipe
+    '''
+
+    def __init__(self, server_address, parent, max_connections, listener=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.parent = parent
+        self.log = parent.log
+        self.max_connections = max_connections
+        self.connections = set()
+        self.posted = deque()
+        self.is_shut_down = threading.Event()
+        self.stopping = False
+
+        if listener is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(server_address)
+            self.listen(ThreadedTCPServer.request_queue_size)
+        else:
+            # Worker process: accept on the socket shared by all workers
+            self.set_socket(listener)
+            self.accepting = True
+        self.wakeup = AsyncWakeup(self)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, client_address = pair
+        if len(self.connections) >= self.max_connections:
+            self.parent.stats.count('rejected', 'connections')
+            try:
+                sock.send(http_response(self.parent.admission.busy_response(), False))
+            except socket.error:
+                pass
+            sock.close()
+            return
+        self.connections.add(AsyncEventChannel(self.parent, self, sock, client_address))
+
+    def connection_closed(self, channel):
+        self.connections.discard(channel)
+
+    def active_connections(self):
+        return len(self.connections)
+
+    def post(self, channel, response):
         '''
-        Confirm existence of db supporting registered plugin
-        If plugin DB is authorized, but doesn't exist, create it
+        Hand a response to the loop; safe to call from any thread
         '''
-        ans = False
-        if plugin is not None:
-            conn = sqlite3.connect(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB))
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute('''SELECT path, default_fields, field_order
-                           FROM "{0}"
-                           WHERE plugin_name = "{1}"'''.format(REGISTERED_PLUGINS_TABLE, plugin))
-            authorized = cur.fetchone()
-            conn.close()
-            if authorized:
-                self.db_path = os.path.join(LOGGING_FOLDER, authorized[b'path'])
-                db_existed = os.path.exists(self.db_path)
-                plugin_conn = sqlite3.connect(self.db_path)
-                if not db_existed:
-                    self.log.info("creating new DB for authorized plugin '{0}'".format(plugin))
-                    with plugin_conn:
-                        p_cur = plugin_conn.cursor()
-                        p_cur.execute('''PRAGMA user_version={0}'''.format(CURRENT_DB_VERSION))
-                        fields = json.loads(authorized[b'default_fields'])
-                        field_order = json.loads(authorized[b'field_order'])
-                        columns = ''
-                        for field in field_order[:-1]:
-                            columns += "{0} {1}, ".format(field, fields[field])
-                        columns += "{0} {1}".format(field_order[-1], fields[field_order[-1]])
-                        args = {'table_name': plugin,
-                                'columns': columns}
-                        p_cur.execute(TABLE_TEMPLATE.format(**args))
-                ans = True
-        return ans
+        self.posted.append((channel, response))
+        if threading.current_thread() is not self.loop_thread:
+            self.wakeup.wake()
+
+    def deliver_posted(self):
+        while self.posted:
+            channel, response = self.posted.popleft()
+            if channel in self.connections:
+                channel.respond(response)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.loop_thread = threading.current_thread()
+        self.is_shut_down.clear()
+        last_sweep = time.time()
+        try:
+            while not self.stopping:
+                asyncore.loop(timeout=poll_interval, map=self.map, count=1)
+                self.deliver_posted()
+                now = time.time()
+                if now - last_sweep > 1.0:
+                    self.close_idle(now - KEEPALIVE_TIMEOUT)
+                    last_sweep = now
+        finally:
+            for channel in list(self.connections):
+                channel.close()
+            self.wakeup.close()
+            asyncore.dispatcher.close(self)
+            self.is_shut_down.set()
 
+    def close_idle(self, cutoff):
+        '''
+        Drop keep-alive connections idle since before cutoff
+        '''
+        for channel in [c for c in self.connections if c.idle_since(cutoff)]:
+            channel.close()
+
+    def shutdown(self):
+        self.stopping = True
+        self.wakeup.wake()
+        self.is_shut_down.wait()
+
+    def handle_error(self):
+        import traceback
+        self.log.error(traceback.format_exc())
+
+
+class PluginExport(object):
+    '''
+    Write exported rows to a binary file object as they are read
+    ndjson: one JSON object per row, extras expanded
+    csv: a header row, then one row per row, UTF-8
+    columns: gzipped JSON lines, a header naming the columns, then for
+    each chunk of rows a list of every column's values
+    '''
+
+    def __init__(self, out, format, plugin, columns):
+        self.format = format
+        self.columns = columns
+        self.extras = columns.index(EXTRAS_COLUMN) if EXTRAS_COLUMN in columns else None
+        if format == 'columns':
+            self.out = gzip.GzipFile(fileobj=out, mode='wb')
+            self.write_line({'plugin': plugin, 'columns': columns})
+        else:
+            self.out = out
+        if format == 'csv':
+            self.csv = csv.writer(out)
+            self.csv.writerow(columns)
+
+    def write_line(self, value):
+        self.out.write(json.dumps(value) + '\n')
+
+    def write(self, rows):
+        if self.format == 'ndjson':
+            for row in rows:
+                row = list(row)
+                if self.extras is not None and row[self.extras]:
+                    row[self.extras] = json.loads(row[self.extras])
+                self.write_line(OrderedDict(zip(self.columns, row)))
+        elif self.format == 'csv':
+            self.csv.writerows([[value.encode('utf-8') if isinstance(value, type(u'')) else value
+                                 for value in row] for row in rows])
+        else:
+            self.write_line({'rows': len(rows), 'values': [list(values) for values in zip(*rows)]})
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    def close(self):
+        if self.format == 'columns':
+            self.out.close()
 
 
 class PluginEventLogger(object):
@@ -300,8 +2743,70 @@ class PluginEventLogger(object):
         PORT = 7584             # PLUG
 
     def __init__(self):
+        global LOGGING_FOLDER
         self.args = self.init_parser()
+        if self.args.folder:
+            LOGGING_FOLDER = os.path.abspath(self.args.folder)
+        if self.args.port:
+            self.PORT = self.args.port
+        self.log_queue = None
         self.log = self.initialize_logger()
+        self.trusted_relays = set([ip.strip() for ip in self.args.trusted_relays.split(',') if ip.strip()])
+        self.registry = PluginRegistry({})
+        self.registry_lock = threading.Lock()
+        self.stats = ServerStats()
+        self.countries = CountryIndex.load('')
+        self.plugin_dbs = {}
+        self.plugin_dbs_lock = threading.Lock()
+        # Partitions being written by late events or expired, each claimed
+        # by one thread at a time
+        self.retention_lock = threading.Condition()
+        self.claimed_partitions = set()
+        # With --workers, only the writer processes expire partitions: one
+        # forked while a retention thread held a claim would hang
+        self.runs_retention = not self.args.workers
+        # False in worker processes, which leave the DBs to the writers
+        self.owns_dbs = True
+        self.worker_processes = None
+        self.stopping = False
+        self.spool = None
+        self.replayer = None
+        self.prepare_locks = {}
+
+    def close_plugin_dbs(self):
+        '''
+        Close every managed plugin DB connection
+        '''
+        with self.plugin_dbs_lock:
+            for db in self.plugin_dbs.values():
+                db.close()
+            self.plugin_dbs = {}
+
+    def create_missing_db(self, authorized):
+        '''
+        Create the DB for a registered plugin whose DB has gone missing,
+        then refresh the registry so later requests skip the check
+        '''
+        if not self.owns_dbs:
+            return
+        with self.registry_lock:
+            if not os.path.exists(authorized.db_path):
+                # Any open connection refers to the deleted file
+                with self.prepare_lock(authorized.name):
+                    self.prepare_plugin_db(authorized, authorized.db_path)
+            if not self.registry.get(authorized.name).db_exists:
+                self.reload_registry()
+
+    def create_plugin_table(self, conn, plugin, fields, field_order):
+        '''
+        Create the plugin table from its registered fields
+        '''
+        columns = ', '.join(["{0} {1}".format(field, fields[field]) for field in field_order])
+        if EXTRAS_COLUMN not in fields:
+            columns += ', {0} TEXT'.format(EXTRAS_COLUMN)
+        args = {'table_name': plugin,
+                'columns': columns}
+        conn.execute(TABLE_TEMPLATE.format(**args))
 
     def initialize_dbs(self):
         '''
@@ -361,22 +2866,82 @@ class PluginEventLogger(object):
 
             plugins_conn.commit()
 
-        self.instantiate_plugin_dbs(cur)
+        self.upgrade_registry(plugins_conn)
+        self.check_registry(cur)
         plugins_conn.close()
+        self.reload_registry()
+        for authorized in self.registry.plugins.values():
+            self.start_retention(authorized)
+        self.load_countries()
+
+    def upgrade_registry(self, conn):
+        '''
+        Add any REGISTRY_COLUMNS missing from the Registered plugins table
+        '''
+        columns = [c[b'name'] for c in
+                   conn.execute('''PRAGMA table_info("{0}")'''.format(REGISTERED_PLUGINS_TABLE)).fetchall()]
+        for column, column_type in REGISTRY_COLUMNS:
+            if column not in columns:
+                self.log.info("adding '{0}' to '{1}'".format(column, REGISTERED_PLUGINS_DB))
+                conn.execute('''ALTER TABLE "{0}" ADD COLUMN {1} {2}'''.format(
+                    REGISTERED_PLUGINS_TABLE, column, column_type))
+        conn.commit()
+
+    def check_registry(self, cur):
+        '''
+        Warn about registry settings which will be ignored
+        '''
+        for row in cur.execute('''SELECT * FROM "{0}"'''.format(REGISTERED_PLUGINS_TABLE)).fetchall():
+            row = dict(zip(row.keys(), tuple(row)))
+            if row[b'partition_period'] is not None and PluginRegistry.partition_period(row) is None:
+                self.log.warning("WARNING: '{0}' not partitioned, partition_period must be one of {1} "
+                                 "and unique_logins_field empty".format(
+                                 row[b'plugin_name'], ", ".join(sorted(PARTITION_FORMATS))))
+
+    def load_countries(self):
+        '''
+        Load the country IP ranges once; lookups never touch the DB
+        '''
+        countries_db = os.path.join(LOGGING_FOLDER, COUNTRIES_DB)
+        if not os.path.exists(countries_db):
+            self.log.info("'{0}' not found, events will not be located".format(COUNTRIES_DB))
+        try:
+            countries = CountryIndex.load(countries_db)
+        except (sqlite3.Error, EnvironmentError) as e:
+            # Also runs in the SIGHUP handler, which must not raise
+            self.log.error("Error: '{0}' not loaded ({1}), keeping {2} country IP ranges".format(
+                COUNTRIES_DB, e, len(self.countries)))
+            return
+        self.countries = countries
+        if countries.skipped:
+            self.log.warning("WARNING: {0} invalid rows in '{1}' skipped".format(countries.skipped, COUNTRIES_DB))
+        if len(self.countries):
+            self.log.info("{0} country IP ranges loaded".format(len(self.countries)))
 
     def initialize_logger(self):
+        if self.args.report or self.args.export:
+            # Leave the running server's log file alone
+            logging.basicConfig(level=logging.INFO, format='%(message)s')
+            return logging.getLogger('plugin_logger')
         log_file = os.path.join(os.path.expanduser('~'), LOGGING_FOLDER, 'plugin_logger.log')
-        logging.basicConfig(
-            filename=log_file,
-            filemode='w',
-            level=logging.DEBUG,
-            format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        log = logging.getLogger('plugin_logger')
-
+        log_handler = logging.FileHandler(log_file, mode='w')
+        log_handler.setFormatter(logging.Formatter(
+            '%(asctime)s: %(processName)s: %(message)s' if self.args.workers else '%(asctime)s: %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'))
+        handlers = [log_handler]
         if not self.args.quiet:
             console = logging.StreamHandler()
             console.setLevel(logging.DEBUG)
-            log.addHandler(console)
+            handlers.append(console)
+
+        # Handler threads only queue their records
+        self.log_queue = LogQueue(handlers, LOG_QUEUE_SIZE)
+        self.log_queue.start()
+        log = logging.getLogger('plugin_logger')
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
+        log.addHandler(self.log_queue)
+        logging.getLogger(REQUEST_LOGGER).addFilter(RateLimitFilter(LOG_RATE_INTERVAL, LOG_BURST, LOG_SAMPLE))
         return log
 
     def init_parser(self):
@@ -384,6 +2949,66 @@ class PluginEventLogger(object):
         '''
         parser = argparse.ArgumentParser(description="Server handling threader plugin logging events")
         parser.add_argument('-q', '--quiet', default=False, action='store_true', help='Suppress logging messages to console')
+        parser.add_argument('--folder', default=None,
+                            help='Logging folder to use instead of LOGGING_FOLDER')
+        parser.add_argument('--port', default=None, type=int,
+                            help='Port to listen on instead of PORT')
+        parser.add_argument('--engine', default='threaded', choices=['threaded', 'async'],
+                            help='Thread-per-connection server, or a single event loop')
+        parser.add_argument('--max-connections', default=1000, type=int,
+                            help='Maximum concurrent connections')
+        parser.add_argument('--max-inflight', default=500, type=int,
+                            help='Maximum requests being handled at once')
+        parser.add_argument('--retry-after', default=2, type=int,
+                            help='Seconds clients are asked to wait when the server is busy')
+        parser.add_argument('--stats-interval', default=60, type=float,
+                            help='Seconds between statistics summaries in the log, 0 for none')
+        parser.add_argument('--ack', default='durable', choices=['accepted', 'durable'],
+                            help="Acknowledge events once queued ('accepted') or once committed ('durable')")
+        parser.add_argument('--batch-size', default=500, type=int,
+                            help='Maximum events committed per writer transaction')
+        parser.add_argument('--batch-latency', default=0.02, type=float,
+                            help='Maximum seconds an event waits for its batch to fill')
+        parser.add_argument('--queue-size', default=10000, type=int,
+                            help='Maximum events waiting for the writer')
+        parser.add_argument('--spool-size', default=1024, type=int,
+                            help='Megabytes of events to spool to disk while the writer is saturated or '
+                                 'failing, 0 to answer 503 instead')
+        parser.add_argument('--check-threads', default=4, type=int,
+                            help='Threads checking plugin DB schemas in the background after startup, '
+                                 '0 to check each DB when its first event arrives')
+        parser.add_argument('--workers', default=0, type=int,
+                            help='Worker processes accepting on the port, 0 to serve from this process')
+        parser.add_argument('--writers', default=1, type=int,
+                            help='Writer processes with --workers; each plugin DB is written by one of them')
+        parser.add_argument('--relay', default=None, metavar='URL',
+                            help='Forward events to the server at URL, e.g. http://central:8378, '
+                                 'instead of storing them')
+        parser.add_argument('--relay-interval', default=2.0, type=float,
+                            help='Maximum seconds a relay holds events before forwarding them')
+        parser.add_argument('--trusted-relays', default='',
+                            help='Comma-separated addresses of relays whose events keep their '
+                                 'originating address, arrival time and count')
+        parser.add_argument('--report', default=None, metavar='PLUGIN',
+                            help="Print PLUGIN's daily events and installs from its rollup, then exit")
+        parser.add_argument('--days', default=30, type=int,
+                            help='Days covered by --report')
+        parser.add_argument('--by', default=None,
+                            help='Comma-separated fields --report groups by, e.g. plugin_version,calibre_os '
+                                 '(default: all rolled up fields)')
+        parser.add_argument('--export', default=None, metavar='PLUGIN',
+                            help="Write PLUGIN's stored rows to --output, then exit")
+        parser.add_argument('--format', default='ndjson', choices=EXPORT_FORMATS,
+                            help='--export format: ndjson, csv, or columns (gzipped column chunks)')
+        parser.add_argument('--output', default='-',
+                            help='File --export writes, - for stdout')
+        parser.add_argument('--since', default=None,
+                            help='Export rows with a UTC timestamp at or after YYYY-MM-DD[ HH:MM:SS]')
+        parser.add_argument('--until', default=None,
+                            help='Export rows with a UTC timestamp before YYYY-MM-DD[ HH:MM:SS]')
+        parser.add_argument('--state', default=None,
+                            help='File recording how far --export got; each run exports only the rows '
+                                 'timestamped since the previous one')
         return parser.parse_args()
 
     def handler_factory(self):
@@ -391,54 +3016,657 @@ class PluginEventLogger(object):
             return ThreadedTCPRequestHandler(self, *args, **keys)
         return createHandler
 
-    def instantiate_plugin_dbs(self, cur):
+    def create_server(self, listener=None):
         '''
-        Instantiate individual authorized plugin DBs as needed
+        Build the server for the selected engine
         '''
-        cur.execute('''SELECT plugin_name, path, default_fields, field_order, unique_logins_field
-                       FROM "{0}"'''.format(REGISTERED_PLUGINS_TABLE))
-        authorized_plugins = cur.fetchall()
-        for row in authorized_plugins:
-            db_path = os.path.join(LOGGING_FOLDER, row[b'path'])
-            db_existed = os.path.exists(db_path)
+        if self.args.engine == 'async':
+            return AsyncTCPServer((self.HOST, self.PORT), self, self.args.max_connections, listener)
+        return ThreadedTCPServer((self.HOST, self.PORT), self.handler_factory(),
+                                 self, self.args.max_connections, listener)
+
+    def create_listener(self):
+        '''
+        Listening socket shared by the worker processes
+        '''
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.HOST, self.PORT))
+        listener.listen(ThreadedTCPServer.request_queue_size)
+        # Every worker is woken for each connection; the losers of the
+        # race to accept it must not block
+        listener.setblocking(0)
+        return listener
+
+    def instantiate_plugin_dbs(self, plugins):
+        '''
+        Check and open the DBs of registered plugins in the background,
+        --check-threads at a time, while the server accepts events
+        A plugin whose first event arrives sooner is checked on the spot
+        '''
+        plugins = list(plugins)
+        threads = min(self.args.check_threads, len(plugins))
+        if not threads:
+            return
+        todo = Queue.Queue()
+        for authorized in plugins:
+            todo.put(authorized)
+
+        def check():
+            while True:
+                try:
+                    authorized = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.plugin_db(authorized)
+                except Exception as e:
+                    import traceback
+                    self.log.error(traceback.format_exc())
+                    self.log.error("Error: {0} (checking '{1}')".format(e, authorized.name))
+
+        def check_all():
+            started = time.time()
+            workers = [threading.Thread(target=check, name='SchemaCheck') for i in range(threads)]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.log.info("{0} plugin DBs checked in {1:.1f}s".format(len(plugins), time.time() - started))
+
+        t = threading.Thread(target=check_all, name='SchemaChecks')
+        t.daemon = True
+        t.start()
+
+    def prepare_lock(self, plugin):
+        '''
+        Lock held while a plugin's DB is being prepared
+        '''
+        with self.plugin_dbs_lock:
+            return self.prepare_locks.setdefault(plugin, threading.Lock())
+
+    def prepare_plugin_db(self, authorized, db_path, managed=True):
+        '''
+        Create a plugin DB (or partition) if needed, bring it up to date,
+        and open its managed connection, or a short-lived one
+        DBs recorded as current in the registry skip the upgrade check
+        '''
+        plugin = authorized.name
+        db_existed = os.path.exists(db_path)
+        checked = (db_existed and not authorized.partition_period and
+                   authorized.checked_version is not None and
+                   authorized.checked_version >= CURRENT_DB_VERSION)
+        if not checked:
             conn = sqlite3.connect(db_path)
             conn.row_factory = sqlite3.Row
             if not db_existed:
-                plugin = row[b'plugin_name']
                 self.log.info("creating '{0}' DB".format(plugin))
                 conn.execute('''PRAGMA user_version={0}'''.format(CURRENT_DB_VERSION))
-                fields = json.loads(row[b'default_fields'])
-                field_order = json.loads(row[b'field_order'])
-                columns = ''
-                for field in field_order[:-1]:
-                    columns += "{0} {1}, ".format(field, fields[field])
-                columns += "{0} {1}".format(field_order[-1], fields[field_order[-1]])
-                args = {'table_name': plugin,
-                        'columns': columns}
-                conn.execute(TABLE_TEMPLATE.format(**args))
+                self.create_plugin_table(conn, plugin, authorized.default_fields, authorized.field_order)
 
             # Do the updates
-            SchemaUpgrade(conn, row[b'plugin_name'], self.log)
+            SchemaUpgrade(conn, plugin, self.log)
+            if not authorized.partition_period:
+                self.record_checked_version(plugin, db_path)
+
+        if managed:
+            # Long-lived connection used by the handlers
+            db = self.open_plugin_db(plugin, db_path)
+        else:
+            db = PluginDB(plugin, db_path)
+            db.managed = False
+        db.ensure_indexes(authorized.unique_logins_field, self.log)
+        db.ensure_rollup(authorized.default_fields, self.log)
+        db.conn.execute('PRAGMA busy_timeout={0}'.format(int(WRITE_BUSY_TIMEOUT * 1000)))
+        return db
+
+    def record_checked_version(self, plugin, db_path):
+        '''
+        Cache a plugin DB's user_version in the registry
+        '''
+        conn = sqlite3.connect(db_path, timeout=SQLITE_TIMEOUT)
+        try:
+            version = conn.execute('pragma user_version').fetchone()[0]
+        finally:
+            conn.close()
+        conn = sqlite3.connect(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB), timeout=SQLITE_TIMEOUT)
+        try:
+            with conn:
+                conn.execute('''UPDATE "{0}" SET checked_version = ? WHERE plugin_name = ?'''.format(
+                             REGISTERED_PLUGINS_TABLE), (version, plugin))
+        finally:
+            conn.close()
+
+    def open_plugin_db(self, plugin, db_path):
+        '''
+        Open (or reopen) the managed connection for a plugin DB
+        '''
+        db = PluginDB(plugin, db_path)
+        with self.plugin_dbs_lock:
+            previous = self.plugin_dbs.get(plugin)
+            self.plugin_dbs[plugin] = db
+        if previous is not None:
+            previous.close()
+        return db
+
+    def plugin_db(self, authorized, when=None):
+        '''
+        Return the managed connection for a registered plugin,
+        opening it if the plugin was registered after startup
+        For a partitioned plugin, the partition for events received at
+        when, created if it does not exist yet. Events older than the
+        partitions kept live go to the oldest live one, never to an expired
+        period. Only the current partition has a managed connection.
+        '''
+        db_path = authorized.db_path
+        while authorized.partition_period:
+            period, now = authorized.partition_period, time.time()
+            key = partition_key(period, when or now)
+            if authorized.keep_partitions:
+                key = max(key, partition_cutoff(period, max(2, authorized.keep_partitions), now))
+            db_path = partition_path(authorized.db_path, key)
+            if key == partition_key(period, now):
+                break
+            db = self.past_partition_db(authorized, key, db_path)
+            if db is not None:
+                return db
+        db = self.plugin_dbs.get(authorized.name)
+        if db is not None and db.db_path == db_path:
+            return db
+        with self.prepare_lock(authorized.name):
+            db = self.plugin_dbs.get(authorized.name)
+            if db is None or db.db_path != db_path:
+                if authorized.partition_period:
+                    self.log.info("opening '{0}' partition '{1}'".format(
+                        authorized.name, os.path.basename(db_path)))
+                db = self.prepare_plugin_db(authorized, db_path)
+                if authorized.partition_period:
+                    self.start_retention(authorized)
+        return db
+
+    def past_partition_db(self, authorized, key, db_path):
+        '''
+        Short-lived connection to a partition other than the current one,
+        for late events; the caller closes it
+        The partition is claimed until then, so retention never compresses
+        or drops it while it is being written. None if it expired while
+        waiting for its claim.
+        '''
+        self.claim_partition(db_path)
+        try:
+            if authorized.keep_partitions and key < partition_cutoff(
+                    authorized.partition_period, max(2, authorized.keep_partitions), time.time()):
+                self.release_partition(db_path)
+                return None
+            with self.prepare_lock(authorized.name):
+                db = self.prepare_plugin_db(authorized, db_path, managed=False)
+        except:
+            self.release_partition(db_path)
+            raise
+        db.release = lambda: self.release_partition(db_path)
+        return db
+
+    def claim_partition(self, path):
+        '''
+        Wait until no other thread is writing or expiring a partition
+        '''
+        with self.retention_lock:
+            while path in self.claimed_partitions:
+                self.retention_lock.wait()
+            self.claimed_partitions.add(path)
+
+    def release_partition(self, path):
+        with self.retention_lock:
+            self.claimed_partitions.discard(path)
+            self.retention_lock.notify_all()
+
+    def plugin_db_paths(self, authorized, since=None):
+        '''
+        DB files holding a plugin's events, newest first
+        For a partitioned plugin, the live partitions holding events
+        received at or after since, then any DB from before partitioning
+        Compressed partitions are skipped; gunzip one to query it again
+        '''
+        paths = []
+        if authorized.partition_period:
+            first = partition_key(authorized.partition_period, since) if since is not None else ''
+            for key, path, compressed in reversed(partition_paths(authorized.db_path)):
+                if key < first:
+                    break
+                if not compressed:
+                    paths.append(path)
+        if os.path.exists(authorized.db_path):
+            paths.append(authorized.db_path)
+        return paths
+
+    def query_plugin(self, authorized, sql, params=(), since=None):
+        '''
+        Run a read-only query against each of a plugin's DBs in turn,
+        yielding the rows of all of them, newest DB first
+        '''
+        for path in self.plugin_db_paths(authorized, since):
+            conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+            try:
+                for row in conn.execute(sql, params):
+                    yield row
+            finally:
+                conn.close()
+
+    def start_retention(self, authorized):
+        if self.runs_retention and authorized.partition_period and authorized.keep_partitions:
+            t = threading.Thread(target=self.expire_partitions, args=(authorized,),
+                                 name='PartitionRetention')
+            t.daemon = True
+            t.start()
+
+    def expire_partitions(self, authorized):
+        '''
+        Compress or drop the partitions older than keep_partitions periods
+        At least the current and previous partitions are kept, so late
+        events never land in an expired one
+        Each partition is claimed only while it is expired, so late events
+        for other partitions are written meanwhile
+        '''
+        cutoff = partition_cutoff(authorized.partition_period,
+                                  max(2, authorized.keep_partitions), time.time())
+        for key, path, compressed in partition_paths(authorized.db_path):
+            if key >= cutoff:
+                break
+            live_path = partition_path(authorized.db_path, key)
+            self.claim_partition(live_path)
+            try:
+                if authorized.expired_partitions == 'drop':
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(path + suffix):
+                            os.remove(path + suffix)
+                    self.log.info("dropped expired partition '{0}'".format(os.path.basename(path)))
+                elif not compressed and os.path.exists(path):
+                    # Another retention pass may have compressed it already
+                    self.compress_partition(path)
+            except Exception as e:
+                self.log.error("Error: {0} (expiring '{1}')".format(e, os.path.basename(path)))
+            finally:
+                self.release_partition(live_path)
+
+    def compress_partition(self, path):
+        '''
+        Vacuum an expired partition and replace it with a gzipped copy
+        An existing archive is never replaced
+        '''
+        if os.path.exists(path + '.gz'):
+            self.log.warning("WARNING: '{0}' is already archived, '{1}' left uncompressed".format(
+                os.path.basename(path + '.gz'), os.path.basename(path)))
+            return
+        conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        try:
+            # Fold the WAL back into the DB file, then compact it
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        with open(path, 'rb') as source:
+            target = gzip.open(path + '.gz.part', 'wb')
+            try:
+                shutil.copyfileobj(source, target)
+            finally:
+                target.close()
+        os.rename(path + '.gz.part', path + '.gz')
+        os.remove(path)
+        self.log.info("compressed expired partition '{0}'".format(os.path.basename(path)))
 
     def launch_server(self):
         self.doneEvent = threading.Event()
         signal.signal(signal.SIGTERM, self.terminate)
-
-        self.server = ThreadedTCPServer((self.HOST, self.PORT), self.handler_factory())
+        signal.signal(signal.SIGHUP, self.reload)
+        if self.args.relay:
+            self.launch_relay()
+            return
+        if self.args.workers > 0:
+            self.launch_processes()
+            return
+
+        self.writer = EventWriter(self, self.args.queue_size, self.args.batch_size,
+                                  self.args.batch_latency, self.args.ack == 'durable')
+        self.writer.start()
+        self.instantiate_plugin_dbs(self.registry.plugins.values())
+        self.replay_spool('events')
+        self.open_spool('events')
+        self.serve()
+
+    def launch_relay(self):
+        '''
+        Accept events like any server, but forward them to --relay
+        The registry is only used to turn away unregistered plugins; no
+        plugin DB is opened. Events are acknowledged once queued, whatever
+        --ack says: waiting for the upstream would hold every client for
+        up to --relay-interval. Forwards that fail are spooled.
+        '''
+        if self.args.workers > 0:
+            raise SystemExit("--relay serves from a single process, drop --workers")
+        self.owns_dbs = False
+        self.writer = RelayWriter(self, self.args.relay, self.args.queue_size, self.args.batch_size,
+                                  self.args.relay_interval, False)
+        self.writer.start()
+        self.log.info("relaying events to {0}".format(self.args.relay))
+        self.replay_spool('events')
+        self.open_spool('events')
+        self.serve()
+
+    def launch_processes(self):
+        '''
+        Serve from --workers processes accepting on one pre-forked socket
+        Each plugin DB is owned by one of --writers writer processes; the
+        workers route every event to its owner, so no two processes ever
+        write the same DB
+        '''
+        listener = self.create_listener()
+        self.writer = EventWriter(self, self.args.queue_size, self.args.batch_size,
+                                  self.args.batch_latency, True)
+        self.writer.start()
+        # Worker 1's replayer retries what fails again
+        self.replay_spool('worker-1')
+        self.writer.stop()
+        # Each process opens its own connections
+        self.close_plugin_dbs()
+        self.writer_queues = [multiprocessing.Queue(self.args.queue_size) for i in range(self.args.writers)]
+        replies = [multiprocessing.Queue() for i in range(self.args.workers)]
+        writer_processes = [multiprocessing.Process(target=self.run_writer, name='writer {0}'.format(i + 1),
+                                                    args=(i, self.writer_queues[i], replies))
+                            for i in range(self.args.writers)]
+        worker_processes = [multiprocessing.Process(target=self.run_worker, name='worker {0}'.format(i + 1),
+                                                    args=(i, listener, self.writer_queues, replies[i]))
+                            for i in range(self.args.workers)]
+        # Fork with the log drained and no handler lock held
+        self.log_queue.stop()
+        for process in writer_processes + worker_processes:
+            process.start()
+        self.log_queue.start()
+        listener.close()
+        self.writer_processes = writer_processes
+        self.worker_processes = worker_processes
+        self.log.info("launched {0} workers and {1} writers listening on port {2}".format(
+            self.args.workers, self.args.writers, self.PORT))
+
+        # Wake up now and then so signals are handled
+        while not self.doneEvent.wait(1.0):
+            pass
+
+    def run_writer(self, index, queue, replies):
+        '''
+        Writer process: commit the events routed here until the parent
+        queues None, after every worker has exited
+        '''
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, self.reload)
+        self.log_queue.start()
+        owned = [authorized for authorized in self.registry.plugins.values()
+                 if writer_index(authorized.name, self.args.writers) == index]
+        self.instantiate_plugin_dbs(owned)
+        self.runs_retention = True
+        for authorized in owned:
+            self.start_retention(authorized)
+        self.writer = RoutedEventWriter(self, queue, replies, self.args.batch_size, self.args.batch_latency)
+        self.writer.run()
+        self.close_plugin_dbs()
+        self.log_queue.stop()
+
+    def run_worker(self, worker, listener, queues, replies):
+        '''
+        Worker process: serve requests, routing events to the writers
+        '''
+        self.doneEvent = threading.Event()
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload)
+        self.log_queue.start()
+        self.owns_dbs = False
+        self.writer = WriterClient(queues, replies, worker, self.args.queue_size, self.args.ack == 'durable')
+        self.writer.start()
+        self.open_spool('worker-{0}'.format(worker + 1))
+        self.serve(listener)
+        self.log_queue.stop()
+
+    def open_spool(self, name):
+        '''
+        Spool for events the writer cannot take, and its replayer
+        '''
+        if self.args.spool_size <= 0:
+            return
+        self.spool = Spool(os.path.join(LOGGING_FOLDER, SPOOL_FOLDER), name,
+                           self.args.spool_size * 1024 * 1024, self.log)
+        self.replayer = SpoolReplayer(self, self.spool)
+        self.replayer.start()
+
+    def replay_spool(self, name):
+        '''
+        Store the events spooled by earlier runs before accepting new ones
+        Events which fail again go to the spool called name, so the live
+        replayer of that spool retries them
+        '''
+        folder = os.path.join(LOGGING_FOLDER, SPOOL_FOLDER)
+        paths = Spool.segments(folder)
+        if not paths:
+            return
+        self.log.info("replaying {0} spool files…".format(len(paths)))
+        spool = Spool(folder, name, sys.maxsize, self.log)
+        SpoolReplayer(self, spool).replay(paths)
+        spool.close()
+
+    def serve(self, listener=None):
+        self.admission = AdmissionControl(self.args.max_inflight, self.writer, self.args.retry_after, self.spool)
+        self.reporter = None
+        if self.args.stats_interval > 0:
+            self.reporter = StatsReporter(self, self.args.stats_interval)
+            self.reporter.start()
+
+        self.server = self.create_server(listener)
         if DEVELOPMENT:
-            self.log.info("launching plugin logging server listening on {0}:{1}".format(self.HOST, self.PORT))
+            self.log.info("launching {0} plugin logging server listening on {1}:{2}".format(
+                self.args.engine, self.HOST, self.PORT))
         else:
-            self.log.info("launching plugin logging server listening on port {1}".format(self.PORT))
+            self.log.info("launching {0} plugin logging server listening on port {1}".format(
+                self.args.engine, self.PORT))
         self.server.serve_forever()
 
         self.doneEvent.wait()
 
+    def report(self):
+        '''
+        Print a plugin's daily rollup, newest day first
+        Reads only the rollup tables, never the raw events, across every
+        live partition of a partitioned plugin
+        '''
+        registry = PluginRegistry.load(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB))
+        authorized = registry.get(self.args.report)
+        since = time.time() - (self.args.days - 1) * 86400
+        paths = self.plugin_db_paths(authorized, since) if authorized is not None else []
+        if not paths:
+            raise SystemExit("no DB for plugin '{0}'".format(self.args.report))
+
+        rollup_table = ROLLUP_TABLE.format(authorized.name)
+        installs_table = ROLLUP_INSTALLS_TABLE.format(authorized.name)
+        conn = sqlite3.connect(paths[0], timeout=SQLITE_TIMEOUT)
+        try:
+            columns = [c[1] for c in conn.execute('''PRAGMA table_info("{0}")'''.format(rollup_table))]
+            has_installs = conn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?''',
+                                        (installs_table,)).fetchone() is not None
+        finally:
+            conn.close()
+        if not columns:
+            raise SystemExit("'{0}' has no rollup yet, start the server to create it".format(authorized.name))
+        dimensions = [d for d in ROLLUP_DIMENSIONS if d in columns]
+        if self.args.by is None:
+            by = dimensions
+        else:
+            by = [d.strip() for d in self.args.by.split(',') if d.strip()]
+            for d in by:
+                if d not in dimensions:
+                    raise SystemExit("'{0}' is not rolled up, choose from {1}".format(
+                        d, ", ".join(dimensions)))
+
+        day = time.strftime('%Y-%m-%d', time.gmtime(since))
+        group = "".join([", " + d for d in by])
+        totals = {}
+        for row in self.query_plugin(authorized, '''SELECT day{0}, SUM(events), SUM(installs) FROM "{1}"
+                                                   WHERE day >= ?
+                                                   GROUP BY day{0}'''.format(group, rollup_table),
+                                     (day,), since):
+            events, installs = totals.get(row[:-2], (0, 0))
+            totals[row[:-2]] = (events + row[-2], installs + row[-1])
+
+        # Summed installs count an install once per group it was seen
+        # in; over fewer fields, count each install once
+        if by != dimensions and has_installs:
+            installs = dict([(row[:-1], row[-1]) for row in self.query_plugin(
+                authorized, '''SELECT day{0}, COUNT(DISTINCT install) FROM "{1}"
+                               WHERE day >= ?
+                               GROUP BY day{0}'''.format(group, installs_table), (day,), since)])
+            for key, (events, _) in totals.items():
+                totals[key] = (events, installs.get(key, 0))
+
+        print('\t'.join(['day'] + by + ['events', 'installs']))
+        keys = sorted(totals)
+        keys.sort(key=lambda key: key[0], reverse=True)
+        for key in keys:
+            print(u'\t'.join([u'{0}'.format(value) for value in key + totals[key]]).encode('utf-8'))
+
+    def export(self):
+        '''
+        Stream a plugin's rows to --output, oldest DB first, holding one
+        chunk of rows in memory at a time
+        '''
+        registry = PluginRegistry.load(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB))
+        authorized = registry.get(self.args.export)
+        if authorized is None:
+            raise SystemExit("'{0}' is not a registered plugin".format(self.args.export))
+        try:
+            since = parse_timestamp(self.args.since) if self.args.since else None
+            until = parse_timestamp(self.args.until) if self.args.until else None
+        except ValueError as e:
+            raise SystemExit(str(e))
+        if self.args.state:
+            exported_before = self.read_export_state(authorized)
+            if exported_before is not None:
+                since = max(since, exported_before) if since else exported_before
+            settled = time.strftime(TIMESTAMP_FORMAT, time.gmtime(time.time() - EXPORT_SETTLE))
+            until = min(until, settled) if until else settled
+        if (since or until) and 'timestamp' not in authorized.default_fields:
+            raise SystemExit("'{0}' has no timestamp to export by".format(authorized.name))
+
+        columns = list(authorized.field_order)
+        if EXTRAS_COLUMN not in columns:
+            columns.append(EXTRAS_COLUMN)
+        conditions, params = [], []
+        if since:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until:
+            conditions.append('timestamp < ?')
+            params.append(until)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        first = calendar.timegm(time.strptime(since, TIMESTAMP_FORMAT)) if since else None
+
+        out = sys.stdout if self.args.output == '-' else open(self.args.output, 'wb')
+        rows = 0
+        try:
+            export = PluginExport(out, self.args.format, authorized.name, columns)
+            for path in reversed(self.plugin_db_paths(authorized, first)):
+                conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+                try:
+                    present = [c[1] for c in conn.execute('''PRAGMA table_info("{0}")'''.format(authorized.name))]
+                    if not present or (conditions and 'timestamp' not in present):
+                        continue
+                    # DBs created before a field was registered lack its column
+                    cur = conn.execute('''SELECT {0} FROM "{1}"{2}'''.format(
+                        ", ".join([c if c in present else 'NULL' for c in columns]),
+                        authorized.name, where), params)
+                    while True:
+                        chunk = cur.fetchmany(EXPORT_CHUNK)
+                        if not chunk:
+                            break
+                        export.write(chunk)
+                        rows += len(chunk)
+                finally:
+                    conn.close()
+            export.close()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if self.args.state:
+            self.write_export_state(authorized, until)
+        self.log.info("exported {0} '{1}' rows{2}{3}".format(
+            rows, authorized.name, " since {0}".format(since) if since else "",
+            " before {0}".format(until) if until else ""))
+
+    def read_export_state(self, authorized):
+        '''
+        Timestamp the previous incremental export stopped short of
+        '''
+        if not os.path.exists(self.args.state):
+            return None
+        try:
+            with open(self.args.state, 'rb') as f:
+                state = json.load(f)
+            if state['plugin'] != authorized.name:
+                raise SystemExit("'{0}' records exports of '{1}'".format(self.args.state, state['plugin']))
+            return parse_timestamp(state['exported_before'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise SystemExit("'{0}' is not an export state file ({1})".format(self.args.state, e))
+
+    def write_export_state(self, authorized, until):
+        with open(self.args.state + '.part', 'wb') as f:
+            json.dump({'plugin': authorized.name, 'exported_before': until}, f)
+        os.rename(self.args.state + '.part', self.args.state)
+
+    def reload(self, signum, frame):
+        self.log.info("SIGHUP received, reloading registered plugins…")
+        self.reload_registry()
+        self.load_countries()
+        if self.worker_processes:
+            for process in self.writer_processes + self.worker_processes:
+                os.kill(process.pid, signal.SIGHUP)
+
+    def reload_registry(self):
+        '''
+        Build a fresh registry snapshot and swap it in
+        '''
+        self.registry = PluginRegistry.load(os.path.join(LOGGING_FOLDER, REGISTERED_PLUGINS_DB))
+        self.log.info("{0} registered plugins loaded".format(len(self.registry)))
+
     def shutdownHandler(self, msg, event):
-        self.server.shutdown()
+        if self.worker_processes:
+            self.shutdown_processes()
+        else:
+            self.server.shutdown()
+            if self.replayer is not None:
+                self.replayer.stop()
+            if self.reporter is not None:
+                self.reporter.stop()
+            self.writer.stop()
+            if self.spool is not None:
+                self.spool.close()
+            self.close_plugin_dbs()
         self.log.info("shutdown complete")
         event.set()
 
+    def shutdown_processes(self):
+        '''
+        Stop the workers, then let the writers drain their queues
+        '''
+        for process in self.worker_processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.worker_processes:
+            process.join()
+        for queue in self.writer_queues:
+            queue.put(None)
+        for process in self.writer_processes:
+            process.join()
+
     def terminate(self, signal, frame):
+        if self.stopping:
+            return
+        self.stopping = True
         self.log.info("SIGTERM received, shutting down…")
         t = threading.Thread(target = self.shutdownHandler, args = ('SIGTERM received', self.doneEvent))
         t.start()
@@ -446,8 +3674,15 @@ class PluginEventLogger(object):
 
 def main():
     pel = PluginEventLogger()
+    if pel.args.report:
+        pel.report()
+        return
+    if pel.args.export:
+        pel.export()
+        return
     pel.initialize_dbs()
     pel.launch_server()
+    pel.log_queue.stop()
 
 if __name__ == '__main__':
     main()